@@ -0,0 +1,151 @@
+#!/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the render strategies with the brute-force render.
+
+Each strategy is a set of parameters applied on top of the fractal
+parameters. The frames are rendered repeat times, the best time is
+reported with the number of pixels that differ from the brute-force frame.
+The iterations per second are the iterations of the brute-force frame,
+without the interior checks, divided by the render time, so that the
+strategies compare on the same work.
+
+With --sweep, the julia thumbnails of a grid of c values rendered in one
+launch are compared with one render per c.
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+import yaml
+
+import numpy as np
+import pygame
+
+from utils.controller import DEFAULT_PARAMETERS
+from utils.fractal import Fractal
+
+
+STRATEGIES = {
+    "brute-force": {},
+    "subdivision": {"subdivision": True},
+    "specialize": {"specialize": True},
+}
+
+
+def usage(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=float,
+                        default=float(os.environ.get("SIZE", 4)),
+                        help="render size x for (160x90) * x")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of renders per strategy")
+    parser.add_argument("--strategy", action="append",
+                        choices=list(STRATEGIES),
+                        help="strategies to compare, all by default")
+    parser.add_argument("--sweep", type=int, metavar="COUNT",
+                        help="compare a COUNT x COUNT julia sweep")
+    parser.add_argument("params", help="fractal parameters",
+                        nargs='?',
+                        default="complex_parameters/mandelbrot.yaml")
+    parser.add_argument("variant", help="variant parameters", nargs='?')
+    args = parser.parse_args(argv)
+    params = copy.deepcopy(DEFAULT_PARAMETERS)
+    params.update(yaml.safe_load(open(args.params)))
+    if args.variant is not None:
+        params.update(params["variants"][args.variant])
+    args.params = params
+    args.winsize = tuple(map(lambda x: int(x * args.size), [160, 90]))
+    if not args.strategy:
+        args.strategy = list(STRATEGIES)
+    return args
+
+
+def render(params, winsize, repeat):
+    """Return the best render time and the frame pixels"""
+    scene = Fractal(winsize, params)
+    times = []
+    for frame in range(repeat):
+        scene.draw = True
+        # Compute the whole frame, not only the pixels exposed by a pan
+        scene.previous_view = None
+        start_time = time.monotonic()
+        scene.render(frame)
+        times.append(time.monotonic() - start_time)
+    # The first render includes the kernel build
+    return min(times[1:] or times), pygame.surfarray.array2d(scene.surface)
+
+
+def iterations(params, winsize):
+    """Return the iterations of the brute-force frame, or None when the
+    kernel doesn't count them"""
+    scene = Fractal(winsize, dict(params, cardioid_check=False,
+                                  periodicity_check=False))
+    scene.count_iterations = True
+    scene.render(0)
+    return scene.iterations
+
+
+def sweep(params, winsize, count, repeat):
+    """Print the thumbnails per second of a sweep and of the renders"""
+    params = dict(params, julia=True)
+    c_min = complex(params["c_real"], params["c_imag"]) - (0.5 + 0.5j)
+    c_max = c_min + (1 + 1j)
+    scene = Fractal(winsize, params)
+    times = []
+    for _ in range(repeat):
+        start_time = time.monotonic()
+        scene.sweep(c_min, c_max, count, winsize)
+        times.append(time.monotonic() - start_time)
+    elapsed = min(times[1:] or times)
+    print("%-16s %8.3f sec  %7.1f thumbnails/s" % (
+        "sweep", elapsed, count * count / elapsed))
+    start_time = time.monotonic()
+    steps = np.linspace(0, 1, count)
+    for c in (c_min + complex(x, y) for x in steps for y in steps):
+        scene.params.update(c_real=c.real, c_imag=c.imag)
+        scene.draw = True
+        scene.previous_view = None
+        scene.render(0)
+    elapsed = time.monotonic() - start_time
+    print("%-16s %8.3f sec  %7.1f thumbnails/s" % (
+        "renders", elapsed, count * count / elapsed))
+
+
+def main():
+    args = usage()
+    if args.sweep:
+        return sweep(args.params, args.winsize, args.sweep, args.repeat)
+    reference = None
+    count = iterations(args.params, args.winsize)
+    for name in ["brute-force"] + args.strategy:
+        if name == "brute-force" and reference is not None:
+            continue
+        params = copy.deepcopy(args.params)
+        params.update(STRATEGIES[name])
+        elapsed, pixels = render(params, args.winsize, args.repeat)
+        if reference is None:
+            reference = (elapsed, pixels)
+        rate = ""
+        if count is not None:
+            rate = "  %8.1f Miter/s" % (count / elapsed / 1e6)
+        print("%-16s %8.3f sec  %7.2f Mpixel/s%s  x%.2f  %d/%d pixels differ"
+              % (name, elapsed, pixels.size / elapsed / 1e6, rate,
+                 reference[0] / elapsed,
+                 np.count_nonzero(pixels != reference[1]), pixels.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,20 @@ from utils.controller import Controller
 log = logging.getLogger()
 
 
+def devices(value):
+    """Return the --devices value, "all" or a number of devices"""
+    if value == "all":
+        return value
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid value: %r, expected all or a number" % value)
+    return count
+
+
 def usage(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser()
     parser.add_argument("--size", type=float,
@@ -38,6 +52,20 @@ def usage(argv=sys.argv[1:]):
                         help="record rendering destination")
     parser.add_argument("--fps", type=int, default=25,
                         help="frames per second")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="compute the next frame while displaying")
+    parser.add_argument("--preview", action="store_true",
+                        help="preview the zooms while they are computed")
+    parser.add_argument("--subdivision", action="store_true",
+                        help="fill the regions of the same color")
+    parser.add_argument("--map-tiles", choices=("memory", "disk"),
+                        help="compose the map with cached tiles")
+    parser.add_argument("--backend", choices=("opencl", "numpy"),
+                        help="render with OpenCL or with numpy")
+    parser.add_argument("--devices", metavar="all|N", type=devices,
+                        help="split the frames between the devices")
+    parser.add_argument("--autotune", action="store_true",
+                        help="tune the work group size of the kernels")
     parser.add_argument("--debug", action="store_true",
                         help="show debug information")
     parser.add_argument("params", help="fractal parameters",
@@ -65,6 +93,21 @@ def usage(argv=sys.argv[1:]):
         args.params = json.loads(args.params)
     if args.super_sampling:
         args.params["super_sampling"] = args.super_sampling
+    if args.pipeline:
+        args.params["pipeline"] = True
+    if args.preview:
+        args.params["zoom_preview"] = True
+    if args.backend:
+        args.params["backend"] = args.backend
+    if args.autotune:
+        args.params["autotune"] = True
+    if args.devices:
+        args.params["devices"] = args.devices
+    if args.subdivision:
+        args.params["subdivision"] = True
+    if args.map_tiles:
+        args.params["map_tiles"] = True
+        args.params["map_tiles_disk"] = args.map_tiles == "disk"
     args.winsize = list(map(lambda x: int(x * args.size), [160,  90]))
     args.map_size = list(map(lambda x: x//5, args.winsize))
     logging.basicConfig(
@@ -90,8 +133,7 @@ class MapController(Controller):
             else:
                 step = 4/3.0
             self.params[view_prefix + "radius"] *= step
-            self.params[view_prefix + "center_real"] = plane_coord.real
-            self.params[view_prefix + "center_imag"] = plane_coord.imag
+            self.move_center(scene, ev.pos, view_prefix)
             if scene == self.scene.map_scene:
                 self.params["i_step"] = self.params["map_radius"] / 10.
                 self.params["r_step"] = self.params["map_radius"] / 10.
@@ -14,13 +14,31 @@
 """
 Randomly explorer IFS function
 
-* TODO: add automatic evaluation of the result:
-** check for color distribution of different c value
-** check for smooth variation when c or mod changes
+With --search, the formulas are evaluated without a window: the julia set
+of each one is rendered at a low resolution, for c and the c shifted by
+about one pixel around it, in a single sweep launch. It is scored with the
+entropy of its colors histogram, times its stability when c changes. The
+best ones are written as complex_parameters files. The scores are kept in
+the output directory, so that the formulas already evaluated are skipped.
 """
 
+import argparse
+import concurrent.futures
 import copy
+import hashlib
+import heapq
+import json
+import logging
+import os
 import random
+import sys
+import time
+
+import numpy as np
+import yaml
+
+
+log = logging.getLogger()
 
 
 class FormulaTree:
@@ -30,16 +48,19 @@ class FormulaTree:
         self.operation = None
 
 
-def generate():
-    """This return valid opencl code:
+# The operations with a real operand, on the right or on the left
+REAL_RIGHT = ("addr", "mulr", "divider", "powr")
+REAL_LEFT = ("radd", "rmul", "rdivide", "rpow")
+ABS = ("iabs", "rabs", "fabs")
 
-    >>> generate()
-    "z = cdouble_divider(cdouble_tan(cdouble_divider(cdouble_mul(c, z), mod)),
-                        4.901648073450788) ;"
 
-    >>> generate()
-    "z = cdouble_fabs(cdouble_exp(cdouble_sub(z, c)));"
-    """
+class Degenerate(Exception):
+    """The formula doesn't depend on z, or has an infinite constant"""
+
+
+def generate_tree():
+    """Return a random FormulaTree, the leaves are "z", "c", "mod" or
+    constant strings"""
     root = FormulaTree()
 
     operations = ["pow", "mul", "add", "sub", "divide"]
@@ -84,37 +105,324 @@ def generate():
             if node.left == "const":
                 node.left = str(random.random() * random.randint(0, 10))
         root = node
+    return root
 
-    def render_opencl(tree):
-        s = []
-        s.append("cdouble_" + tree.operation + "(")
-        if isinstance(tree.left, FormulaTree):
-            s.extend(render_opencl(tree.left))
-            s.append(", ")
-        elif tree.left is not None:
-            s.append(tree.left)
-            s.append(", ")
-        #    if tree.left is None:
-        #        s.append("(")
-        if isinstance(tree.right, FormulaTree):
-            s.extend(render_opencl(tree.right))
-        else:
-            s.append(tree.right)
-        s.append(") ")
-        return s
 
-    return ("z = " + "".join(render_opencl(root)) + ";")
+def node(operation, left, right):
+    tree = FormulaTree()
+    tree.operation, tree.left, tree.right = operation, left, right
+    return tree
+
+
+def is_constant(value):
+    return isinstance(value, complex)
+
+
+def normalize(tree):
+    """Return the canonical form of a tree, where the constants are
+    complex numbers.
+
+    The constant subtrees are folded, the identities (x + 0, x * 1, x - x,
+    abs(abs(x)), ...) are simplified, the real operands are moved to the
+    r operations, and the operands of add and mul are sorted.
+    """
+    from utils.cpu import FUNCTIONS
+    if not isinstance(tree, FormulaTree):
+        if tree is None or tree in ("z", "c", "mod"):
+            return tree
+        return complex(float(tree))
+    op = tree.operation
+    left, right = normalize(tree.left), normalize(tree.right)
+    if (left is None or is_constant(left)) and is_constant(right):
+        # Constant folding
+        args = [value for value in (left, right) if value is not None]
+        if op in REAL_RIGHT or op in REAL_LEFT:
+            args = [np.complex128(value) for value in args]
+        with np.errstate(all="ignore"):
+            value = complex(FUNCTIONS["cdouble_" + op](*args))
+        if not np.isfinite(value):
+            raise Degenerate(tree)
+        return value
+    if left is None:
+        if op in ABS and isinstance(right, FormulaTree) and \
+                right.operation in ABS:
+            # abs(abs(x)), the real and imaginary abs make a fabs
+            if op != right.operation:
+                op = "fabs"
+            return node(op, None, right.right)
+        return node(op, None, right)
+    # The constants of the complex operations move to the real operations,
+    # pyopencl has no real sub
+    if op == "sub" and is_constant(right) and not is_constant(left):
+        op, right = "add", -right
+    for constant, other, real_op in ((left, right, "r" + op),
+                                     (right, left, op + "r")):
+        if op in ("add", "mul", "divide", "pow") and \
+                is_constant(constant) and constant.imag == 0 and \
+                not is_constant(other):
+            op = real_op
+            break
+    # The commutative operations take their real operand on the right
+    if op in ("radd", "rmul"):
+        op, left, right = op[1:] + "r", right, left
+    if op in REAL_RIGHT and is_constant(right):
+        k = right.real
+        if (k == 0 and op == "addr") or \
+                (k == 1 and op in ("mulr", "divider", "powr")):
+            return left
+        if k == 0 and op == "mulr":
+            return 0j
+        if k == 0 and op == "powr":
+            return 1 + 0j
+        if k == 0 and op == "divider":
+            raise Degenerate(tree)
+    if op in REAL_LEFT and is_constant(left):
+        if left.real == 0 and op == "rdivide":
+            return 0j
+        if left.real == 1 and op == "rpow":
+            return 1 + 0j
+    if op in ("sub", "divide", "add") and \
+            render_opencl(left) == render_opencl(right):
+        if op == "sub":
+            return 0j
+        if op == "divide":
+            return 1 + 0j
+        return node("mulr", left, 2 + 0j)
+    if op in ("add", "mul") and \
+            render_opencl(left) > render_opencl(right):
+        left, right = right, left
+    return node(op, left, right)
+
+
+def render_opencl(tree, real=False):
+    """Return the OpenCL code of a tree, real is set for the real operands
+    of the r operations"""
+    if not isinstance(tree, FormulaTree):
+        if is_constant(tree):
+            if real:
+                return repr(tree.real)
+            return "cdouble_new(%r, %r)" % (tree.real, tree.imag)
+        return tree
+    s = []
+    s.append("cdouble_" + tree.operation + "(")
+    if tree.left is not None:
+        s.append(render_opencl(tree.left, tree.operation in REAL_LEFT))
+        s.append(", ")
+    s.append(render_opencl(tree.right, tree.operation in REAL_RIGHT))
+    s.append(") ")
+    return "".join(s)
+
+
+def leaves(tree):
+    if not isinstance(tree, FormulaTree):
+        return {tree}
+    return leaves(tree.left) | leaves(tree.right)
+
+
+def generate():
+    """This return valid opencl code:
+
+    >>> generate()
+    "z = cdouble_divider(cdouble_tan(cdouble_divider(cdouble_mul(c, z), mod)),
+                        4.901648073450788) ;"
+
+    >>> generate()
+    "z = cdouble_fabs(cdouble_exp(cdouble_sub(z, c)));"
+
+    The formulas are normalized, the ones that don't depend on z and c
+    are skipped.
+    """
+    while True:
+        try:
+            tree = normalize(generate_tree())
+        except Degenerate:
+            continue
+        if isinstance(tree, FormulaTree) and {"z", "c"} <= leaves(tree):
+            return "z = " + render_opencl(tree) + ";"
+
+
+class FormulaStore:
+    """The scores of the evaluated formulas, keyed by the hash of their
+    canonical form, and saved as json"""
+    def __init__(self, path=None):
+        self.path = path
+        self.scores = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.scores = json.load(f)
+
+    @staticmethod
+    def key(formula):
+        return hashlib.sha256(formula.encode("utf-8")).hexdigest()
+
+    def __contains__(self, formula):
+        return self.key(formula) in self.scores
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, formula, result):
+        """Store the (score, entropy, stability) result, None when the
+        formula failed"""
+        self.scores[self.key(formula)] = [formula, result]
+
+    def best(self, count):
+        return heapq.nlargest(
+            count, ((tuple(result), formula)
+                    for formula, result in self.scores.values()
+                    if result is not None))
+
+    def save(self):
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.scores, f)
+        os.replace(tmp, self.path)
+
+
+def usage(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search", type=int, metavar="COUNT",
+                        help="score COUNT formulas without a window")
+    parser.add_argument("--top", type=int, default=10,
+                        help="number of formulas to keep")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="number of formulas compiled in parallel")
+    parser.add_argument("--probe", type=int, nargs=2, default=(64, 36),
+                        metavar=("WIDTH", "HEIGHT"), help="probe size")
+    parser.add_argument("--output", default="search",
+                        help="directory of the kept formulas")
+    parser.add_argument("params", nargs="?",
+                        default="complex_parameters/quack.yaml",
+                        help="fractal parameters")
+    return parser.parse_args(argv)
+
+
+def entropy(pixels):
+    """Return the colors histogram entropy, normalized to [0, 1]"""
+    _, counts = np.unique(pixels, return_counts=True)
+    if len(counts) < 2:
+        return 0.
+    p = counts / len(pixels)
+    return float(-(p * np.log2(p)).sum() / np.log2(len(pixels)))
+
+
+def similarity(pixels, other):
+    """Return 1 minus the mean channel difference of two frames"""
+    a = pixels.view(np.uint8).reshape(-1, 4)[:, :3].astype(np.int32)
+    b = other.view(np.uint8).reshape(-1, 4)[:, :3].astype(np.int32)
+    return 1. - float(np.abs(a - b).max(axis=1).mean()) / 255.
+
+
+class Search:
+    """Render and score the formulas in-process"""
+    def __init__(self, args):
+        from utils.controller import DEFAULT_PARAMETERS
+        self.params = copy.deepcopy(DEFAULT_PARAMETERS)
+        self.base = yaml.safe_load(open(args.params))
+        self.base.pop("variants", None)
+        self.params.update(self.base)
+        self.params["show_map"] = False
+        self.args = args
+
+    def probe(self, formula):
+        """Return the probe scene of a formula, compiling its kernel"""
+        from utils.fractal import Fractal
+        params = copy.deepcopy(self.params)
+        params["formula"] = formula
+        # The scene program is the one of the sweep
+        params["plane_mode"] = "sweep"
+        return Fractal(self.args.probe, params)
+
+    def score(self, scene):
+        """Return the (score, entropy, stability) of a probe scene, the
+        2 x 2 julia thumbnails of c and of c shifted on each axis"""
+        width, height = self.args.probe
+        c = complex(scene.params["c_real"], scene.params["c_imag"])
+        shift = scene.params["radius"] / width * (1 + 1j)
+        mosaic = scene.sweep(c, c + shift, 2, self.args.probe)
+        pixels = [mosaic[i * width:(i + 1) * width,
+                         j * height:(j + 1) * height].ravel()
+                  for i in range(2) for j in range(2)]
+        quality = entropy(pixels[0])
+        stability = float(np.mean([similarity(pixels[0], other)
+                                   for other in pixels[1:]]))
+        return quality * stability, quality, stability
+
+    def run(self):
+        import pyopencl as cl
+        os.makedirs(self.args.output, exist_ok=True)
+        store = FormulaStore(os.path.join(self.args.output, "scores.json"))
+        # The base formula creates the OpenCL context before the threads
+        print("Base formula score: %.3f (entropy %.3f, stability %.3f)" %
+              self.score(self.probe(self.params["formula"])))
+        start = time.monotonic()
+        count = duplicates = 0
+        pool = concurrent.futures.ThreadPoolExecutor(self.args.jobs)
+        while count < self.args.search:
+            batch = set()
+            while len(batch) < min(self.args.jobs * 4,
+                                   self.args.search - count):
+                formula = generate()
+                if formula in store or formula in batch:
+                    # Already evaluated
+                    duplicates += 1
+                    continue
+                batch.add(formula)
+            # The kernels are compiled by the pool, the probes are rendered
+            # as they are ready
+            futures = {pool.submit(self.probe, formula): formula
+                       for formula in batch}
+            for future in concurrent.futures.as_completed(futures):
+                count += 1
+                formula = futures[future]
+                try:
+                    result = self.score(future.result())
+                except (cl.Error, RuntimeError) as e:
+                    log.debug("%s: %s", formula, e)
+                    result = None
+                if result is not None and not np.isfinite(result[0]):
+                    result = None
+                store.add(formula, result)
+            store.save()
+            elapsed = time.monotonic() - start
+            best = store.best(1)
+            print("%d formulas, %.0f per hour, %d duplicates skipped, best "
+                  "score %.3f" % (count, count * 3600 / elapsed, duplicates,
+                                  best[0][0][0] if best else 0))
+        pool.shutdown()
+        # The best of this run and of the previous ones
+        return store.best(self.args.top)
+
+    def save(self, results):
+        os.makedirs(self.args.output, exist_ok=True)
+        for rank, ((score, quality, stability), formula) in enumerate(
+                results):
+            params = dict(self.base)
+            params["formula"] = formula
+            # The scores are the ones of the julia set
+            params["julia"] = True
+            fname = os.path.join(self.args.output, "%02d.yaml" % rank)
+            with open(fname, "w") as f:
+                f.write("# score %.3f, entropy %.3f, stability %.3f\n" % (
+                    score, quality, stability))
+                f.write(yaml.dump(params, default_flow_style=False))
+            print("%s: %.3f %s" % (fname, score, formula))
 
 
 def main():
+    args = usage()
+    if args.search:
+        search = Search(args)
+        search.save(search.run())
+        return
     import subprocess
     try:
         while True:
-            argv = ["./explorer_complex.py", "--size", "3",
-                    "complex_parameters/quack.yaml",
+            argv = ["./explorer_complex.py", "--size", "3", args.params,
                     '{"formula": "%s"}' % generate()]
             subprocess.Popen(argv).wait()
     except KeyboardInterrupt:
         pass
 
+
 main()
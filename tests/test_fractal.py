@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import copy
+import os
+import sys
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+pygame = pytest.importorskip("pygame")
+yaml = pytest.importorskip("yaml")
+opencl = pytest.importorskip("utils.opencl")
+
+from utils.controller import DEFAULT_PARAMETERS  # noqa: E402
+from utils.fractal import Fractal  # noqa: E402
+
+
+if not opencl.available():
+    pytest.skip("OpenCL is not available", allow_module_level=True)
+
+
+@pytest.fixture(autouse=True, scope="module")
+def kernel_cache(tmp_path_factory):
+    # The test kernels are not stored in the user cache
+    cache = opencl.OpenCLCompute.cache
+    opencl.OpenCLCompute.cache = opencl.KernelCache(
+        str(tmp_path_factory.mktemp("kernels")))
+    yield
+    opencl.OpenCLCompute.cache = cache
+
+
+def parameters(**kwargs):
+    params = copy.deepcopy(DEFAULT_PARAMETERS)
+    params.update(precision="double", **kwargs)
+    return params
+
+
+def render(scene):
+    scene.render(0)
+    return pygame.surfarray.array2d(scene.surface)
+
+
+def test_map_subdivision():
+    # The map scene renders with the main program, without subdivision
+    maps = []
+    for subdivision in (False, True):
+        params = parameters(julia=True, c_real=-0.5, c_imag=0.5,
+                            subdivision=subdivision)
+        scene = Fractal((64, 36), params)
+        scene.create_map_scene((32, 18), params)
+        maps.append(render(scene.map_scene))
+    assert np.array_equal(maps[0], maps[1])
+
+
+def test_recolor():
+    # A recolor from the value buffer matches a direct render
+    with open(os.path.join(os.path.dirname(__file__), "..",
+                           "complex_parameters", "m2.yaml")) as f:
+        params = parameters(**yaml.safe_load(f))
+    params.update(precision="double", pipeline=False, zoom_preview=False,
+                  super_sampling=1)
+    scene = Fractal((64, 36), dict(params, value_buffer=True))
+    render(scene)
+    scene.params["grad_freq"] = 2.5
+    scene.draw = True
+    recolored = render(scene)
+    direct = render(Fractal((64, 36), dict(params, grad_freq=2.5)))
+    assert np.array_equal(recolored & 0xffffff, direct & 0xffffff)
+
+
+def test_autotune_counter(tmp_path, monkeypatch):
+    # The tuning runs don't count in the iterations saved of the frame
+    monkeypatch.setattr(opencl.OpenCLCompute, "cache",
+                        opencl.KernelCache(str(tmp_path)))
+    saved = []
+    for autotune in (True, False):
+        scene = Fractal((64, 36), parameters(
+            autotune=autotune, cardioid_check=True, periodicity_check=True,
+            pipeline=False))
+        render(scene)
+        saved.append(scene.iterations_saved)
+    assert saved[0] == saved[1] > 0
+
+
+@pytest.mark.parametrize("precision", ["float", "double"])
+def test_pan(precision):
+    # The pixels kept by a pan are the ones of a full render
+    params = parameters(super_sampling=2, pipeline=False,
+                        zoom_preview=False)
+    params["precision"] = precision
+    scene = Fractal((64, 36), params)
+    render(scene)
+    for dx, dy in ((5, 0), (-3, 7)):
+        params["center_real"] += dx * scene.pixel_size()[0]
+        params["center_imag"] += dy * scene.pixel_size()[1]
+        scene.draw = True
+        panned = render(scene)
+        assert np.array_equal(panned, render(Fractal((64, 36), params)))
+
+
+def test_preview_skips_views(monkeypatch):
+    # The views zoomed while a frame is computed are not computed
+    params = parameters(zoom_preview=True, pipeline=False)
+    scene = Fractal((64, 36), params)
+    render(scene)
+    while scene.pending:
+        scene.render(0)
+    frames = scene.gpu.frames
+    monkeypatch.setattr(scene.gpu, "ready", lambda handle: False)
+    for _ in range(3):
+        params["radius"] *= 0.8
+        scene.draw = True
+        # The preview, then the frame
+        scene.render(0)
+        scene.render(0)
+    monkeypatch.undo()
+    while scene.pending or scene.draw:
+        scene.render(0)
+    assert scene.gpu.frames - frames == 2
+    assert np.array_equal(pygame.surfarray.array2d(scene.surface), render(
+        Fractal((64, 36), dict(params, zoom_preview=False))))
+
+
+def test_buffer_pool():
+    # The buffers of the previous super-sampling sizes are released
+    scene = Fractal((64, 36), parameters(pipeline=False))
+    for super_sampling in range(1, 7):
+        scene.params["super_sampling"] = super_sampling
+        scene.draw = True
+        render(scene)
+    names = collections.Counter(key[:2] for key in scene.gpu.buffers)
+    assert names[("device", "samples")] == opencl.OpenCLCompute.BUFFER_SHAPES
+    assert max(names.values()) <= opencl.OpenCLCompute.BUFFER_SHAPES
@@ -0,0 +1,29 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+cl = pytest.importorskip("pyopencl")
+opencl = pytest.importorskip("utils.opencl")
+
+
+def test_cache_key(tmp_path, monkeypatch):
+    # The binaries of another pyopencl version are not reused
+    cache = opencl.KernelCache(str(tmp_path))
+    key = cache.key("__kernel void compute() {}", [])
+    monkeypatch.setattr(cl, "VERSION_TEXT", cl.VERSION_TEXT + ".1")
+    assert cache.key("__kernel void compute() {}", []) != key
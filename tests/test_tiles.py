@@ -0,0 +1,44 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from utils import tiles  # noqa: E402
+
+
+def render(rects):
+    return [np.zeros(tiles.TILE * tiles.TILE, np.uint32) for _ in rects]
+
+
+def stored(path):
+    return sorted(os.path.relpath(os.path.join(root, name), path)
+                  for root, _, names in os.walk(path) for name in names)
+
+
+def test_disk_eviction(tmp_path):
+    # The disk store keeps the max_stored most recently used tiles
+    cache = tiles.TileCache(str(tmp_path), max_stored=4)
+    step = tiles.SPAN / tiles.TILE
+    cache.compose("p", (0., 0.), (step, step), (tiles.TILE, 2 * tiles.TILE),
+                  render)
+    first = stored(tmp_path)
+    assert len(first) == 2
+    for level in (1, 2):
+        cache.compose("p", (0., 0.), (step / 2 ** level,) * 2,
+                      (tiles.TILE, 2 * tiles.TILE), render)
+    assert len(stored(tmp_path)) == 4
+    assert not set(first) & set(stored(tmp_path))
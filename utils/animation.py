@@ -38,6 +38,8 @@ def usage():
                         help="render size (2.5)")
     parser.add_argument("--super-sampling", type=int,
                         help="super sampling mode")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="compute the next frame while displaying")
     parser.add_argument("--debug", action="store_true",
                         help="show debug information")
     args = parser.parse_args()
@@ -147,6 +149,8 @@ def run_main(demo, Scene=Fractal):
 
     if args.super_sampling:
         demo.params["super_sampling"] = args.super_sampling
+    if args.pipeline:
+        demo.params["pipeline"] = True
 
     demo.map_size = args.map_size
 
@@ -162,6 +166,7 @@ def run_main(demo, Scene=Fractal):
 
     # Warm opencl
     scene.render(0)
+    scene.flush()
     audio.play = False
     demo.silent = True
     for skip in range(args.skip):
@@ -183,16 +188,25 @@ def run_main(demo, Scene=Fractal):
             args.paused = False
 
         if scene.render(frame):
+            # With --pipeline, the displayed frame is the previous one
             screen.update()
             if args.record:
-                screen.capture(os.path.join(args.record, "%04d.png" % frame))
+                screen.capture(os.path.join(
+                    args.record, "%04d.png" % scene.rendered_frame))
             print("%04d: %.2f sec '%s'" % (
-                frame, time.monotonic() - start_time,
+                scene.rendered_frame, time.monotonic() - start_time,
                 json.dumps(demo.get(), sort_keys=True)))
 
         if not args.record:
             clock.tick(args.fps)
 
+    # Display the last pipelined frame
+    while scene.flush():
+        screen.update()
+        if args.record:
+            screen.capture(os.path.join(
+                args.record, "%04d.png" % scene.rendered_frame))
+
     if args.record:
         import subprocess
         cmd = [
@@ -16,6 +16,8 @@ import time
 
 import pygame
 import pygame.locals
+
+from . import perturbation
 try:
     import tkinter
     tk_ftw = True
@@ -30,7 +32,52 @@ DEFAULT_PARAMETERS = {
     "kernel_params": "",
     "kernel_params_mod": [],
     "kernel_variables": "",
+    # Build the kernels per julia value, with the escape tested on the
+    # squared modulus, see specialize.py
+    "specialize": False,
     "super_sampling": 1,
+    # Only super-sample the pixels that differ from their neighbours
+    "adaptive_sampling": False,
+    "adaptive_threshold": 16,
+    "plane_mode": "device",
+    # "opencl", or "numpy" to render on the CPU without OpenCL, which is
+    # also used when OpenCL isn't available
+    "backend": "opencl",
+    # Perturbation rendering of z*z + c, the center may be a decimal string
+    "deep_zoom": False,
+    # Skip the first iterations of z*z + c using the reference orbit
+    "series_approximation": False,
+    "pipeline": False,
+    # Render on every device of the platform: "all" partitions the CPUs per
+    # NUMA node, a number partitions them in as many sub-devices
+    "devices": None,
+    # Benchmark the work group sizes of the kernels on first use, the best
+    # one is stored in the kernel cache and used by the next runs
+    "autotune": False,
+    # Display the last frame scaled to the new view while a zoom is
+    # computed, without blocking the events
+    "zoom_preview": False,
+    # Compute the frames from 1/8 to the full resolution over the next
+    # renders, spending at most frame_budget milliseconds per render
+    "progressive": False,
+    "frame_budget": 40,
+    # Only compute the borders of the regions of the same color, see
+    # utils/subdivision.py
+    "subdivision": False,
+    # Keep the kernel values on the device, so that the grad_freq and the
+    # gradient changes only recolor the frame
+    "value_buffer": False,
+    # Skip the main cardioid and the period-2 bulb of z*z + c
+    "cardioid_check": False,
+    # Stop the iterations when the orbit is periodic, within the tolerance
+    "periodicity_check": False,
+    "periodicity_tolerance": 1e-12,
+    # Kernel floating point precision: float, double-single, double, or auto
+    # to use the fastest one that is precise enough for the view radius
+    "precision": "auto",
+    # Let auto use the double-single emulation, which is faster than double
+    # on most consumer GPUs
+    "double_single": False,
     "formula": "z = cdouble_add(cdouble_mul(z, z), c);",
     "gradient": "AG_coldfire.ggr",
     "gradient_length": 512,
@@ -45,6 +92,10 @@ DEFAULT_PARAMETERS = {
     "map_center_real": 0.0,
     "map_center_imag": 0.0,
     "map_radius": 2.3,
+    # Compose the map with cached tiles instead of rendering it when c
+    # moves, see utils/tiles.py, the tiles may be kept in ~/.cache too
+    "map_tiles": False,
+    "map_tiles_disk": False,
     "c_real": 0.0,
     "c_imag": 0.0,
     "r_step": 1e-1,
@@ -260,6 +311,16 @@ class Controller:
                 self.params[n][idx] = v.get()
         self.scene.draw = True
 
+    def move_center(self, scene, screen_coord, view_prefix=""):
+        """Center the view on screen_coord, keeping the precision of the
+        deep zoom decimal centers"""
+        deep = self.params.get("deep_zoom") and not view_prefix
+        for axis, idx in (("center_real", 0), ("center_imag", 1)):
+            delta = (screen_coord[idx] - scene.window_size[idx] / 2) / \
+                scene.scale[idx]
+            self.params[view_prefix + axis] = perturbation.shift(
+                self.params[view_prefix + axis], delta, deep)
+
     def on_pygame_clic(self, ev):
         plane_coord = self.scene.convert_to_plane(ev.pos)
         if ev.button in (1, 3):
@@ -268,8 +329,7 @@ class Controller:
             else:
                 step = 4/3.0
             self.params["radius"] *= step
-            self.params["center_real"] = plane_coord.real
-            self.params["center_imag"] = plane_coord.imag
+            self.move_center(self.scene, ev.pos)
             self.scene.draw = True
         else:
             print("Clicked", ev.pos, plane_coord)
@@ -339,11 +399,17 @@ class Controller:
         elif scancode in (113, 114):
             if scancode == 113:
                 direction = -1
-            self.params["center_real"] += direction * 10 / self.scene.scale[0]
+            self.params["center_real"] = perturbation.shift(
+                self.params["center_real"],
+                direction * 10 * self.scene.pixel_size()[0],
+                self.params.get("deep_zoom"))
         elif scancode in (111, 116):
             if scancode == 111:
                 direction = -1
-            self.params["center_imag"] += direction * 10 / self.scene.scale[1]
+            self.params["center_imag"] = perturbation.shift(
+                self.params["center_imag"],
+                direction * 10 * self.scene.pixel_size()[1],
+                self.params.get("deep_zoom"))
         elif scancode == 27:
             self.params["center_real"] = self.start_params["center_real"]
             self.params["center_imag"] = self.start_params["center_imag"]
@@ -0,0 +1,245 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""NumPy rendering of the complex kernels, for the hosts without OpenCL.
+
+The formulas are the OpenCL statements, translated to Python with a table
+of the pyopencl-complex cdouble_* helpers to NumPy ufuncs. The z, z2 and c
+variables are complex arrays, whose real and imag fields can be assigned
+like the cdouble_t struct fields.
+
+The pixels are iterated together, and the pixels that escape are removed
+from the arrays, so that each step only computes the active ones. The
+plane is split in tiles computed by a thread pool, as the ufuncs release
+the GIL.
+"""
+
+import concurrent.futures
+import logging
+import os
+import re
+
+import numpy as np
+
+
+log = logging.getLogger()
+
+FUNCTIONS = {
+    "cdouble_new": lambda real, imag: real + 1j * imag,
+    "cdouble_fromreal": lambda real: real + 0j,
+    "cdouble_real": np.real,
+    "cdouble_imag": np.imag,
+    "cdouble_add": np.add,
+    "cdouble_addr": np.add,
+    "cdouble_radd": np.add,
+    "cdouble_sub": np.subtract,
+    "cdouble_subr": np.subtract,
+    "cdouble_rsub": np.subtract,
+    "cdouble_mul": np.multiply,
+    "cdouble_mulr": np.multiply,
+    "cdouble_rmul": np.multiply,
+    "cdouble_divide": np.divide,
+    "cdouble_divider": np.divide,
+    "cdouble_rdivide": np.divide,
+    "cdouble_neg": np.negative,
+    "cdouble_conj": np.conj,
+    "cdouble_abs": np.abs,
+    "cdouble_arg": np.angle,
+    "cdouble_sqrt": np.sqrt,
+    "cdouble_exp": np.exp,
+    "cdouble_log": np.log,
+    "cdouble_pow": np.power,
+    "cdouble_powr": np.power,
+    "cdouble_rpow": np.power,
+    "cdouble_sin": np.sin,
+    "cdouble_cos": np.cos,
+    "cdouble_tan": np.tan,
+    "cdouble_sinh": np.sinh,
+    "cdouble_cosh": np.cosh,
+    "cdouble_tanh": np.tanh,
+    # The mean-distance kernel helpers
+    "cdouble_iabs": lambda z: z.real + 1j * np.abs(z.imag),
+    "cdouble_rabs": lambda z: np.abs(z.real) + 1j * z.imag,
+    "cdouble_fabs": lambda z: np.abs(z.real) + 1j * np.abs(z.imag),
+    # The OpenCL math functions
+    "fabs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "log": np.log,
+    "log2": np.log2,
+    "pow": np.power,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+    "atan2": np.arctan2,
+    "fmin": np.minimum,
+    "fmax": np.maximum,
+}
+
+KERNELS = ("escape-time-gradient", "mean-distance")
+
+
+def translate(formula, kernel_params=()):
+    """Return a formula(z, z2, c, *kernel_params) function, which returns
+    the new z and z2"""
+    lines = []
+    formula = re.sub(r"//[^\n]*", "", formula)
+    for statement in formula.split(";"):
+        statement = " ".join(statement.split())
+        if not statement:
+            continue
+        if re.search(r"[{}]|\b(if|else|for|while|return)\b", statement):
+            raise RuntimeError("%s: unsupported statement" % statement)
+        # The float literals and casts
+        statement = re.sub(r"\b(\d+\.\d*|\.\d+|\d+)f\b", r"\1", statement)
+        statement = re.sub(r"\((double|float|int)\)", "", statement)
+        match = re.fullmatch(r"(\w+) = (\w+)", statement)
+        if match:
+            # The structs are assigned by value
+            statement = "%s = %s.copy()" % match.groups()
+        lines.append(statement)
+    source = "def formula(z, z2, c%s):\n%s\n    return z, z2\n" % (
+        "".join(", " + name for name in kernel_params),
+        "".join("    %s\n" % line for line in lines))
+    namespace = dict(FUNCTIONS)
+    exec(compile(source, "<formula>", "exec"), namespace)
+    return namespace["formula"]
+
+
+def escape_time(formula, z, c, params, max_iter, pre_iter, escape):
+    """Return the escape-time-gradient values, NaN for the interior"""
+    values = np.full(len(z), np.nan)
+    active = np.arange(len(z))
+    z2 = np.zeros_like(z)
+    for iteration in range(max_iter):
+        z, z2 = formula(z, z2, c, *params)
+        modulus = np.abs(z)
+        escaped = modulus > escape
+        if escaped.any():
+            values[active[escaped]] = (
+                iteration - np.log(np.log(modulus[escaped])) / np.log(2.0) +
+                np.log(np.log(escape)) / np.log(2.0)) / max_iter
+            # Only iterate the remaining pixels
+            keep = ~escaped
+            active, z, z2, c = active[keep], z[keep], z2[keep], c[keep]
+            if not len(active):
+                break
+    return values
+
+
+def mean_distance(formula, z, c, params, max_iter, pre_iter, escape):
+    """Return the mean-distance values"""
+    means = np.zeros(len(z))
+    iterations = np.full(len(z), max_iter)
+    active = np.arange(len(z))
+    z2 = np.zeros_like(z)
+    mean = np.zeros(len(z))
+    modulus = np.zeros(len(z))
+    for iteration in range(max_iter):
+        z, z2 = formula(z, z2, c, *params)
+        if iteration > pre_iter:
+            modulus = np.abs(z)
+            mean += modulus
+            escaped = modulus > escape
+            if escaped.any():
+                means[active[escaped]] = mean[escaped]
+                iterations[active[escaped]] = iteration
+                keep = ~escaped
+                active, z, z2, c = active[keep], z[keep], z2[keep], c[keep]
+                mean, modulus = mean[keep], modulus[keep]
+                if not len(active):
+                    break
+    means[active] = mean
+    with np.errstate(all="ignore"):
+        return 1.0 - np.log2(0.5 * np.log2(means / (iterations - pre_iter)))
+
+
+class NumPyCompute:
+    """Render the escape-time-gradient and mean-distance kernels with
+    NumPy, behind the host plane mode interface of OpenCLCompute"""
+    def __init__(self, kernel, formula, kernel_params=(),
+                 escape_distance=4242.0, xyinverted=False, tile=1 << 14,
+                 workers=None):
+        if kernel not in KERNELS:
+            raise RuntimeError("%s: kernel not supported by the numpy "
+                               "backend" % kernel)
+        self.compute = escape_time if kernel == KERNELS[0] else \
+            mean_distance
+        self.formula = translate(formula, kernel_params)
+        self.escape_distance = escape_distance
+        self.xyinverted = xyinverted
+        self.tile = tile
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers or os.cpu_count())
+        # Number of frames submitted
+        self.frames = 0
+
+    def upload(self, name, array):
+        # The arrays are used as is
+        return array
+
+    def upload_plane(self, plane):
+        return plane
+
+    def render(self, plane, *args):
+        return self.wait(self.submit(plane.shape, (plane,), args))
+
+    def submit(self, shape, plane_args, args, super_sampling=1, height=0):
+        """Compute the pixels of the plane, the handle is the pixels"""
+        plane, = plane_args
+        gradient, gradient_length, julia, max_iter, pre_iter, \
+            gradient_frequency, c_real, c_imag = args[:8]
+        params = args[8:]
+        if self.xyinverted:
+            plane = plane.imag + 1j * plane.real
+        if julia:
+            z = plane.astype(np.complex128)
+            c = np.full(len(plane), complex(c_real, c_imag))
+        else:
+            z = np.zeros(len(plane), dtype=np.complex128)
+            c = plane.astype(np.complex128)
+        tiles = [
+            self.pool.submit(
+                self.compute, self.formula, z[start:start + self.tile],
+                c[start:start + self.tile], params, int(max_iter),
+                int(pre_iter), self.escape_distance)
+            for start in range(0, len(plane), self.tile)]
+        values = np.concatenate([tile.result() for tile in tiles])
+        # The COLOR macro, the interior and the invalid values are black
+        pixels = np.zeros(len(values), dtype=np.uint32)
+        valid = np.isfinite(values)
+        index = np.trunc(values[valid] * int(gradient_length) *
+                         float(gradient_frequency)).astype(np.int64)
+        pixels[valid] = gradient[index % int(gradient_length)]
+        if super_sampling > 1:
+            pixels = downscale(pixels, super_sampling, height)
+        self.frames += 1
+        return (pixels,)
+
+    def ready(self, handle):
+        return True
+
+    def wait(self, handle):
+        return handle[0]
+
+
+def downscale(samples, factor, height):
+    """Box filter of the factor x factor samples of each pixel, per
+    channel, like the downscale image kernel"""
+    channels = samples.view(np.uint8).reshape(-1, factor, height, factor, 4)
+    count = factor * factor
+    sums = channels.sum(axis=(1, 3), dtype=np.uint32)
+    return ((sums + count // 2) // count).astype(np.uint8).view(
+        np.uint32).ravel()
@@ -12,14 +12,26 @@
 
 import collections
 import copy
+import hashlib
 import logging
+import time
 
 import numpy as np
 
 
+from . import cpu
 from . import game
 from . import gradient
-from . import opencl
+from . import interior
+from . import perturbation
+from . import precision
+from . import specialize
+from . import subdivision
+from . import tiles
+try:
+    from . import opencl
+except ImportError:
+    opencl = None
 
 
 log = logging.getLogger()
@@ -34,17 +46,156 @@ z = cdouble_log(z);
    """,
 }
 
+# Spellings of the z*z + c formula
+QUADRATIC_FORMULAS = (
+    "z = cdouble_add(cdouble_mul(z, z), c);",
+    "z = cdouble_mul(z, z); z = cdouble_add(z, c);",
+)
+
+
+def is_quadratic(formula):
+    return " ".join(formula.split()) in QUADRATIC_FORMULAS
+
+
+PLANE_MODES = {
+    # The coordinates are computed on the host and uploaded every frame
+    "host": {
+        "plane_args": "__global double2 *plane,",
+        "x": "plane[gid].x",
+        "y": "plane[gid].y",
+    },
+    # Each work item computes its own coordinate on the grid of the view
+    # step, plane_x and plane_y being the grid index of the first pixel, so
+    # that a pixel has the same coordinate in all the views of that step.
+    # The pixels are stored column by column
+    "device": {
+        "plane_args": """double const plane_x,
+    double const plane_y,
+    double const step_x,
+    double const step_y,
+    uint const plane_height,""",
+        "x": "((plane_x + gid / plane_height) * step_x)",
+        "y": "((plane_y + gid % plane_height) * step_y)",
+    },
+    # Each work item computes one sub-sample of a pixel from the
+    # sample_pixels list, the sample_grid x sample_grid samples of a pixel
+    # are the ones of the device mode grid, see samples_view
+    "samples": {
+        "plane_args": """__global uint const *sample_pixels,
+    uint const sample_grid,
+    double const plane_x,
+    double const plane_y,
+    double const step_x,
+    double const step_y,
+    uint const plane_height,""",
+        "x": """((plane_x +
+        sample_pixels[gid / (sample_grid * sample_grid)] / plane_height *
+        sample_grid + (gid % (sample_grid * sample_grid)) / sample_grid) *
+        step_x)""",
+        "y": """((plane_y +
+        sample_pixels[gid / (sample_grid * sample_grid)] % plane_height *
+        sample_grid + gid % sample_grid) * step_y)""",
+    },
+    # Each work item computes one pixel of a mosaic of julia thumbnails,
+    # on the grid of the device mode, the c of the thumbnail replaces the
+    # c_real and c_imag arguments
+    "sweep": {
+        "plane_args": """double const plane_x,
+    double const plane_y,
+    double const step_x,
+    double const step_y,
+    uint const plane_height,
+    uint const thumb_width,
+    uint const thumb_height,
+    double const sweep_real,
+    double const sweep_imag,
+    double const sweep_step_real,
+    double const sweep_step_imag,""",
+        "x": "((plane_x + (gid / plane_height) % thumb_width) * step_x)",
+        "y": "((plane_y + (gid % plane_height) % thumb_height) * step_y)",
+        "c": """cdouble_new(
+            sweep_real + (gid / plane_height / thumb_width) * sweep_step_real,
+            sweep_imag + (gid % plane_height / thumb_height) * sweep_step_imag)
+        """,
+    },
+    # Only used by the double-single kernel
+    "double-single": precision.PLANE_MODE,
+}
+
+
+# The kernels store the pixels with the COLOR and INTERIOR macros, either
+# as gradient colors, or as values colored by the COLOR_KERNEL. The values
+# keep the precision of the kernel, so that the colors are the same: they
+# are stored as ulong pixels in double precision, as uint otherwise
+GRADIENT_COLOR = """
+#define COLOR(value) gradient[(int)( \\
+    (value) * gradient_length * gradient_frequency) % gradient_length]
+#define INTERIOR 0x00000000"""
+
+VALUE_COLOR = """
+#define COLOR(value) as_uint((float)(value))
+#define INTERIOR as_uint(NAN)"""
+
+DOUBLE_VALUE_COLOR = """
+#define COLOR(value) as_ulong((double)(value))
+#define INTERIOR as_ulong((double)NAN)"""
+
+# The iterations of the escape-time kernels are counted in a 64 bits
+# counter made of two uints, see count_iterations
+ITERATIONS_PARAMS = """,
+    __global uint *iterations"""
+
+COUNT_ITERATIONS = """
+    if (atomic_add(&iterations[0], (uint)iter) > UINT_MAX - (uint)iter)
+        atomic_inc(&iterations[1]);"""
+
+COLOR_KERNEL = """
+{extension}
+__kernel void color(
+    __global {value_type} const *values,
+    __global uint *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
+    {real} const gradient_frequency
+) {{
+    int gid = get_global_id(0);
+    {real} value = as_{real}(values[gid]);
+    if (isnan(value)) {{
+        pixels[gid] = 0x00000000;
+    }} else {{
+        pixels[gid] = gradient[(int)(
+            value * gradient_length * gradient_frequency) %
+            gradient_length];
+    }}
+}}
+"""
+
+# The progressive rendering levels, the pixels are first computed one every
+# 8 pixels, then one every 4, 2 and finally all of them
+PROGRESSIVE_LEVELS = (8, 4, 2, 1)
+
+# The parameters that only change the colors of the values
+COLOR_PARAMS = ("grad_freq", "gradient", "gradient_length")
+
+# The parameters that don't change the map tiles
+MAP_VIEW_PARAMS = (
+    "julia", "c_real", "c_imag", "center_real", "center_imag", "radius",
+    "r_step", "i_step", "show_map", "map_center_real", "map_center_imag",
+    "map_radius")
+
 
 DEFAULT_KERNELS = {
     "orbit-rgb": """
-__constant uint gradient[] = {{{gradient_values}}};
+{color_macros}
 #define PYOPENCL_DEFINE_CDOUBLE 1
 #include <pyopencl-complex.h>
 #pragma OPENCL EXTENSION cl_khr_byte_addressable_store : enable
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
 __kernel void compute(
-    __global double2 *plane,
-    __global uint *pixels,
+    {plane_args}
+    __global {pixel_type} *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
     char const julia,
     uint const max_iter,
     uint const pre_iter,
@@ -84,14 +235,14 @@ __kernel void compute(
 
         if (orbit_modulus < trap) {{
             pixels[gid] = gradient[(int)(
-                ((orbit_modulus / trap) * {gradient_length}/10)) + 20];
+                ((orbit_modulus / trap) * gradient_length/10)) + 20];
             break ;
         }}
         orbit_modulus = fabs(z.real - orbit.real);
 
         if (orbit_modulus < trap) {{
             pixels[gid] = gradient[(int)(
-                ((orbit_modulus / trap) * {gradient_length} / 10))];
+                ((orbit_modulus / trap) * gradient_length / 10))];
             // pixels[gid] = 0xff000000 | ((int)(0xff * orbit_modulus / trap) << 8);
             break ;
         }}
@@ -101,9 +252,7 @@ __kernel void compute(
             modulus = iter - log(log(modulus)) / log(2.0f) +
                              log(log(escape)) / log(2.0f);
             modulus = modulus / (double)max_iter;
-            pixels[gid] = gradient[(int)(
-                (modulus * {gradient_length} * gradient_frequency)) %
-                {gradient_length}];
+            pixels[gid] = COLOR(modulus);
             break;
         }}
     }}
@@ -111,14 +260,16 @@ __kernel void compute(
 """,
 
     "orbit-gradient": """
-__constant uint gradient[] = {{{gradient_values}}};
+{color_macros}
 #define PYOPENCL_DEFINE_CDOUBLE 1
 #include <pyopencl-complex.h>
 #pragma OPENCL EXTENSION cl_khr_byte_addressable_store : enable
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
 __kernel void compute(
-    __global double2 *plane,
-    __global uint *pixels,
+    {plane_args}
+    __global {pixel_type} *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
     char const julia,
     uint const max_iter,
     uint const pre_iter,
@@ -170,22 +321,21 @@ __kernel void compute(
         }}
     }}
     distance = sqrt(distance);
-    pixels[gid] = gradient[(int)(
-          (distance * {gradient_length} * gradient_frequency)) %
-          {gradient_length}]
-        ;
+    pixels[gid] = COLOR(distance);
 
 }}
 """,
     "escape-time-gradient": """
-__constant uint gradient[] = {{{gradient_values}}};
+{color_macros}
 #define PYOPENCL_DEFINE_CDOUBLE 1
 #include <pyopencl-complex.h>
 #pragma OPENCL EXTENSION cl_khr_byte_addressable_store : enable
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
 __kernel void compute(
-    __global double2 *plane,
-    __global uint *pixels,
+    {plane_args}
+    __global {pixel_type} *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
     char const julia,
     uint const max_iter,
     uint const pre_iter,
@@ -209,24 +359,27 @@ __kernel void compute(
     {kernel_variables}
     double escape = {escape_distance};
     double modulus = 0.0f;
-    int iter;
-    for (iter = 0; iter < max_iter; iter++) {{
+    int iter = 0;
+    {series_init}
+    pixels[gid] = INTERIOR;
+    {interior_init}
+    for (; iter < max_iter; iter++) {{
         {formula}
         modulus = cdouble_abs(z);
         if (modulus > escape) {{
             modulus = iter - log(log(modulus)) / log(2.0f) +
                              log(log(escape)) / log(2.0f);
             modulus = modulus / (double)max_iter;
-            pixels[gid] = gradient[(int)(
-                (modulus * {gradient_length} * gradient_frequency)) %
-                {gradient_length}];
+            pixels[gid] = COLOR(modulus);
             break;
         }}
+        {interior_check}
     }}
+    {iteration_count}
 }}
 """,
     "mean-distance": """
-__constant uint gradient[] = {{{gradient_values}}};
+{color_macros}
 #define PYOPENCL_DEFINE_CDOUBLE 1
 #include <pyopencl-complex.h>
 #pragma OPENCL EXTENSION cl_khr_byte_addressable_store : enable
@@ -249,8 +402,10 @@ cdouble_t cdouble_fabs(cdouble_t t) {{
 }}
 
 __kernel void compute(
-    __global double2 *plane,
-    __global uint *pixels,
+    {plane_args}
+    __global {pixel_type} *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
     char const julia,
     uint const max_iter,
     uint const pre_iter,
@@ -276,6 +431,7 @@ __kernel void compute(
     double escape = {escape_distance};
     double modulus = 0.0f;
     int iter;
+    {interior_init}
     for (iter = 0; iter < max_iter; iter++) {{
         {formula}
         if (iter > pre_iter) {{
@@ -285,15 +441,41 @@ __kernel void compute(
         if (modulus > escape && iter > pre_iter) {{
             break;
         }}
+        {interior_check}
     }}
+    {iteration_count}
     mean = 1.0 - log2(0.5 * log2(mean / (double)(iter - pre_iter)));
-    pixels[gid] = gradient[(int)(
-        (mean * {gradient_length} * gradient_frequency)) % {gradient_length}];
+    pixels[gid] = COLOR(mean);
 }}
 """,
 }
 
 
+class Trail:
+    """The last length complex values, in a ring buffer"""
+    def __init__(self, length):
+        self.values = np.zeros(length, dtype=np.complex128)
+        # Number of values appended
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, len(self.values))
+
+    def append(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def last(self):
+        return self.values[(self.count - 1) % len(self.values)]
+
+    def array(self):
+        """Return the values, from the oldest to the last"""
+        if self.count <= len(self.values):
+            return self.values[:self.count]
+        start = self.count % len(self.values)
+        return np.concatenate((self.values[start:], self.values[:start]))
+
+
 class Fractal(game.Window, game.ComplexPlane):
     def __init__(self, winsize, params, gpu=None):
         game.Window.__init__(self, winsize)
@@ -302,26 +484,37 @@ class Fractal(game.Window, game.ComplexPlane):
         self.alive = True
         self.mapmode = False
         self.map_scene = None
-        if gpu:
-            self.gpu = gpu
-            self.mapmode = True
-            self.previous_c = collections.deque(maxlen=2000)
-            self.set_view(self.params["map_center_real"],
-                          self.params["map_center_imag"],
-                          self.params["map_radius"])
-            return
-        x, y = 'x', 'y'
-        if params['xyinverted']:
-            x, y = 'y', 'x'
+        # Frames enqueued on the device but not displayed yet
+        self.pending = collections.deque()
+        self.pipeline = params["pipeline"] and not gpu
+        self.rendered_frame = None
+        # Program variants, built on demand
+        self.programs = {}
+        # Gradient lookup tables on the device, keyed by (name, length)
+        self.gradients = {}
+        self.reference_key = None
+        self.tier = None
+        # Iterations skipped by the interior checks in the last frame
+        self.iterations_saved = 0
+        # Count the iterations of the frames, for the benchmark
+        self.count_iterations = False
+        self.iterations = None
+        # The parameters of the values on the device, see value_buffer
+        self.values_params = None
+        # The view of the previous frame, see pan_shift
+        self.previous_view = None
+        # The last displayed view and pixels, see reproject
+        self.preview_source = None
+        # The view of the displayed preview
+        self.previewed = None
+        # The progressive frame being refined, see refine
+        self.progress = None
+        self.progressive_levels = {}
+        # Pixels computed per second by refine
+        self.refine_rate = 1e5
+        # The tile pyramid of the map scene, see map_tiles
+        self.tiles = None
         cl_params = copy.copy(params)
-        cl_params["pos_x"] = "plane[gid]." + x
-        cl_params["pos_y"] = "plane[gid]." + y
-
-        if "gradient" in params:
-            cl_params["gradient_values"] = gradient.generate_array(
-                params["gradient"], params["gradient_length"])
-            cl_params["gradient_length"] = params["gradient_length"]
-
         if cl_params["formula"] in DEFAULT_FORMULAS:
             cl_params["formula"] = DEFAULT_FORMULAS[cl_params["formula"]]
         if cl_params["kernel"] in DEFAULT_KERNELS:
@@ -329,10 +522,103 @@ class Fractal(game.Window, game.ComplexPlane):
 
         if cl_params.get("kernel_params"):
             cl_params["kernel_params"] = "," + cl_params["kernel_params"]
+        cl_params["color_macros"] = GRADIENT_COLOR
+        cl_params["pixel_type"] = "uint"
+        cl_params["series_init"] = ""
+        cl_params["interior_init"] = ""
+        cl_params["interior_check"] = ""
+        cl_params["iteration_count"] = ""
 
-        program = kernel.format(**cl_params)
+        self.kernel_source = kernel
+        self.cl_params = cl_params
+        # The map scene renders with the program of the main scene, its
+        # compute still reads the cl_params
+        if gpu:
+            self.gpu = gpu
+            self.mapmode = True
+            self.previous_c = Trail(2000)
+            if params["map_tiles"] and not self.numpy_backend():
+                # The tiles are computed with the device plane mode
+                self.tiles = tiles.TileCache(
+                    tiles.cache_path() if params["map_tiles_disk"] else None)
+                source = self.format_program("device")
+                self.tile_program = self.gpu.build(source)
+                self.tiles_source = hashlib.sha256(source.encode("utf-8"))
+            self.set_view(float(self.params["map_center_real"]),
+                          float(self.params["map_center_imag"]),
+                          self.params["map_radius"])
+            return
+        program = self.format_program(params["plane_mode"])
         log.debug(program)
-        self.gpu = opencl.OpenCLCompute(program)
+        if params["backend"] == "numpy" or opencl is None or \
+                not opencl.available():
+            self.gpu = self.numpy_compute()
+        elif params["devices"]:
+            # Split the frames between the devices
+            self.gpu = opencl.DevicePool(program, opencl.pool_devices(
+                None if params["devices"] == "all"
+                else int(params["devices"])), params["autotune"])
+        else:
+            self.gpu = opencl.OpenCLCompute(program, params["autotune"])
+        if params["deep_zoom"] and not is_quadratic(cl_params["formula"]):
+            log.warning("Deep zoom only supports the z*z + c formula")
+
+    def numpy_compute(self):
+        return cpu.NumPyCompute(
+            self.params["kernel"], self.cl_params["formula"],
+            self.params["kernel_params_mod"],
+            float(self.params["escape_distance"]),
+            self.params["xyinverted"])
+
+    def numpy_backend(self):
+        return isinstance(self.gpu, cpu.NumPyCompute)
+
+    def format_program(self, plane_mode, kernel_source=None,
+                       tier=precision.DOUBLE, julia=None, **overrides):
+        """Return the kernel source for a plane mode and a precision tier,
+        specialized for the julia value when set"""
+        x, y = 'x', 'y'
+        if self.params['xyinverted']:
+            x, y = 'y', 'x'
+        if kernel_source is None:
+            kernel_source = self.kernel_source
+        cl_params = dict(self.cl_params)
+        plane_mode = PLANE_MODES[plane_mode]
+        cl_params["plane_args"] = plane_mode["plane_args"]
+        cl_params["pos_x"] = plane_mode[x]
+        cl_params["pos_y"] = plane_mode[y]
+        # Overrides may use the template variables too
+        for key, value in overrides.items():
+            cl_params[key] = value.format(**cl_params)
+        source = kernel_source.format(**cl_params)
+        if "c" in plane_mode:
+            source = source.replace("cdouble_new(c_real, c_imag)",
+                                    plane_mode["c"])
+        if julia is not None:
+            source = specialize.kernel(source, julia)
+        if tier == precision.FLOAT:
+            source = precision.single_precision(source)
+        return source
+
+    def program(self, plane_mode, kernel_source=None, tier=precision.DOUBLE,
+                **overrides):
+        """Return a program variant, built on first use"""
+        if self.mapmode:
+            # The map scene uses the main scene program
+            return self.gpu.kernel
+        julia = None
+        if self.params["specialize"]:
+            julia = bool(self.params["julia"]) or plane_mode == "sweep"
+        key = (plane_mode, kernel_source, tier, julia,
+               tuple(sorted(overrides.items())))
+        if key not in self.programs:
+            options = ()
+            if tier != precision.DOUBLE:
+                options = precision.SINGLE_OPTIONS
+            self.programs[key] = self.gpu.build(self.format_program(
+                plane_mode, kernel_source, tier, julia, **overrides),
+                options)
+        return self.programs[key]
 
     def render(self, frame):
         if self.map_scene:
@@ -342,47 +628,670 @@ class Fractal(game.Window, game.ComplexPlane):
         if self.map_scene:
             updated = self.map_scene.render(frame)
         if not self.draw:
-            return updated
+            if self.progress is not None and not self.pending:
+                # Refine the progressive frame
+                handle = self.refine()
+                if handle is None:
+                    return updated
+                self.display(frame, handle)
+                return True
+            # Display the last pipelined frame, or the previewed frame once
+            # it is computed
+            return self.flush(wait=self.pipeline) or updated
+        view = self.current_view()
+        if self.zoom_preview():
+            if self.previewed != view:
+                preview = self.reproject()
+                if preview is not None:
+                    # Display the preview before computing the frame, which
+                    # is submitted by a next render
+                    self.blit(preview)
+                    self.previewed = view
+                    return True
+            if self.pending:
+                # One frame is computed at a time: the frame of the newest
+                # view is submitted once the pending one is computed, and
+                # the pending one is dropped as its view is outdated
+                if not self.gpu.ready(self.pending[0][1]):
+                    return updated
+                self.pending.clear()
+        self.previewed = None
+        handle = self.submit()
+        self.draw = False
+        if self.pipeline:
+            # Display the previous frame while this one is computed
+            self.pending.append((frame, handle, view))
+            if len(self.pending) < 2:
+                return updated
+            frame, handle, view = self.pending.popleft()
+        elif self.zoom_preview():
+            # Keep the events going while the frame is computed
+            self.pending.append((frame, handle, view))
+            return self.flush(wait=False) or updated
+        self.display(frame, handle, view)
+        return True
+
+    def flush(self, wait=True):
+        """Display the oldest pending frame, return False if none, or if
+        it isn't computed yet and wait is False"""
+        if not self.pending:
+            return False
+        if not wait and not self.gpu.ready(self.pending[0][1]):
+            return False
+        self.display(*self.pending.popleft())
+        return True
+
+    def zoom_preview(self):
+        return self.params["zoom_preview"] and not self.pipeline and \
+            not self.mapmode
+
+    def current_view(self):
+        return ((self.params["center_real"], self.params["center_imag"]),
+                self.params["radius"])
+
+    def reproject(self):
+        """Return the last displayed frame scaled to a zoomed view"""
+        if self.preview_source is None:
+            return None
+        (center, radius), pixels = self.preview_source
+        new_center, new_radius = self.current_view()
+        if radius == new_radius:
+            return None
+        width, height = self.window_size
+        positions = []
+        for axis, size in enumerate(self.window_size):
+            # The pixels position in the last frame
+            offset = perturbation.difference(new_center[axis], center[axis])
+            positions.append(np.rint(
+                (np.arange(size) - (size - 1) / 2) * (new_radius / radius) +
+                (size - 1) / 2 + offset * (size - 1) / (2 * radius)
+            ).astype(np.int64))
+        x, y = positions
+        inside = ((x >= 0) & (x < width))[:, np.newaxis] & \
+            ((y >= 0) & (y < height))[np.newaxis, :]
+        preview = pixels.reshape(width, height)[
+            np.clip(x, 0, width - 1)[:, np.newaxis],
+            np.clip(y, 0, height - 1)[np.newaxis, :]]
+        preview[~inside] = 0
+        return preview
+
+    def submit(self):
+        """Enqueue the frame, returns a handle for display"""
+        if self.value_buffer():
+            params = self.values_key()
+            if params == self.values_params:
+                # Only the colors changed
+                return self.gpu.recolor(
+                    (self.length,), *self.color(self.tier),
+                    self.params["super_sampling"], self.window_size[1])
+            self.values_params = params
+        handle = self.compute()
+        counters = {}
+        if self.interior_checks():
+            counters["interior_saved"] = self.interior_counter
+        if self.iteration_count():
+            counters["iterations"] = self.iterations_counter
+        if counters:
+            # Read the counters along with the pixels
+            for name, buf in counters.items():
+                event, counters[name] = self.gpu.read_counter(
+                    name, buf, (self.length,))
+            handle = (event, handle[1], counters)
+        return handle
+
+    def compute(self):
+        # A new frame stops the refinement of the previous one
+        self.progress = None
+        if self.tiles is not None:
+            return self.map_tiles()
         if self.mapmode:
             view_prefix = "map_"
         else:
             view_prefix = ""
         super_sampling = self.params["super_sampling"]
-        self.set_view(self.params[view_prefix + "center_real"],
-                      self.params[view_prefix + "center_imag"],
-                      self.params[view_prefix + "radius"])
-        x = np.linspace(self.plane_min[0], self.plane_max[0],
-                        self.window_size[0] * super_sampling)
-        y = np.linspace(self.plane_min[1], self.plane_max[1],
-                        self.window_size[1] * super_sampling) * 1j
-        plane = np.ravel(y+x[:, np.newaxis]).astype(np.complex128)
-        render_args = [
-            plane,
-            np.byte(self.params["julia"] and not self.mapmode),
+        center = (self.params[view_prefix + "center_real"],
+                  self.params[view_prefix + "center_imag"])
+        radius = self.params[view_prefix + "radius"]
+        self.set_view(float(center[0]), float(center[1]), radius)
+        overrides = {}
+        if self.deep_zoom():
+            kernel_source = perturbation.KERNEL
+            render_args = self.reference_args(center, radius)
+            # The coordinates are relative to the reference orbit
+            extent = ((-radius, -radius), (radius, radius))
+        else:
+            kernel_source = None
+            render_args = [
+                np.byte(self.params["julia"] and not self.mapmode),
+                np.uint32(self.params["max_iter"]),
+                np.uint32(self.params.get("pre_iter", 0)),
+                np.double(self.params["grad_freq"]),
+                np.double(self.params["c_real"]),
+                np.double(self.params["c_imag"]),
+            ]
+            for kernel_param in self.params["kernel_params_mod"]:
+                render_args.append(np.double(self.params[kernel_param]))
+            if self.numpy_backend():
+                # Only the host plane mode, without the device features
+                return self.gpu.submit(
+                    (self.length,), (self.host_plane(
+                        (self.plane_min, self.plane_max), super_sampling),),
+                    self.gradient_args() + render_args, super_sampling,
+                    self.window_size[1])
+            kernel_params = self.cl_params["kernel_params"]
+            if self.series_approximation():
+                render_args.extend(self.series_args(center, radius))
+                kernel_params += perturbation.SERIES_PARAMS
+                overrides["series_init"] = perturbation.SERIES_INIT
+            if self.interior_checks():
+                self.interior_counter = self.gpu.counter("interior_saved")
+                render_args.append(self.interior_counter)
+                kernel_params += interior.INTERIOR_PARAMS
+                overrides.update(self.interior_overrides())
+            if self.iteration_count():
+                self.iterations_counter = self.gpu.counter("iterations")
+                render_args.append(self.iterations_counter)
+                kernel_params += ITERATIONS_PARAMS
+                overrides["iteration_count"] = COUNT_ITERATIONS
+            if kernel_params != self.cl_params["kernel_params"]:
+                overrides["kernel_params"] = kernel_params
+            extent = (self.plane_min, self.plane_max)
+        tier = self.precision_tier(center, radius)
+        if tier != self.tier:
+            log.info("Rendering in %s precision", tier)
+            self.tier = tier
+        color = None
+        if self.value_buffer():
+            color = self.color(tier)
+            if tier == precision.DOUBLE:
+                overrides["color_macros"] = DOUBLE_VALUE_COLOR
+                overrides["pixel_type"] = "ulong"
+            else:
+                overrides["color_macros"] = VALUE_COLOR
+        plane_mode = self.params["plane_mode"]
+        if tier == precision.DOUBLE_SINGLE:
+            plane_mode = "double-single"
+            kernel_source = precision.DOUBLE_SINGLE_KERNEL
+            render_args = render_args[:3] + [
+                np.float32(render_args[3]),
+                precision.split(render_args[4]),
+                precision.split(render_args[5])]
+        elif tier == precision.FLOAT:
+            render_args = precision.single_args(render_args)
+        render_args = self.gradient_args() + render_args
+        shift = self.pan_shift(self.view(extent, super_sampling), tier)
+        if self.adaptive_sampling():
+            # First pass at 1x, then sub-sample only the edge pixels
+            handle = self.gpu.submit_adaptive(
+                (self.length,),
+                precision.view_args(self.view(extent, 1), tier),
+                precision.view_args(
+                    self.samples_view(extent, super_sampling), tier),
+                render_args,
+                self.program("samples", kernel_source, tier, **overrides),
+                super_sampling, self.params["adaptive_threshold"],
+                program=self.program(
+                    "device", kernel_source, tier, **overrides))
+            log.debug("Adaptive sampling: %d/%d pixels refined",
+                      self.gpu.refined, self.length)
+            return handle
+        if self.progressive():
+            # The frame is refined by the next renders
+            self.progress = [
+                self.program("samples", kernel_source, tier, **overrides),
+                precision.view_args(
+                    self.samples_view(extent, super_sampling), tier),
+                render_args, 0, 0]
+            return self.refine(first=True)
+        if self.subdivision():
+            # Only compute the borders of the uniform regions
+            program = self.program("samples", kernel_source, tier, **overrides)
+            view = precision.view_args(
+                self.samples_view(extent, super_sampling), tier)
+            pixels, filled = subdivision.render(
+                *self.window_size, lambda gids: self.gpu.evaluate(
+                    (self.length,), gids, view, render_args, super_sampling,
+                    program))
+            log.debug("Subdivision: %d/%d pixels filled", filled, self.length)
+            return self.gpu.submit_host((self.length,), pixels.ravel())
+        program = self.program(plane_mode, kernel_source, tier, **overrides)
+        if shift is not None:
+            # Only compute the pixels exposed by the translation
+            rects = [
+                (x, y, width, height, precision.view_args(
+                    self.view(extent, super_sampling, x, y, height), tier))
+                for x, y, width, height in self.exposed(shift)]
+            log.debug("Panning by %s: %d/%d pixels computed", shift,
+                      sum(rect[2] * rect[3] for rect in rects), self.length)
+            return self.gpu.submit_shifted(
+                (self.length,), self.window_size[1], shift, rects,
+                render_args, super_sampling, program=program)
+        if plane_mode != "host":
+            view = precision.view_args(
+                self.view(extent, super_sampling), tier)
+        else:
+            view = (self.gpu.upload_plane(
+                self.host_plane(extent, super_sampling, tier)),)
+        return self.gpu.submit(
+            (self.length,), view, render_args,
+            super_sampling, self.window_size[1], program=program,
+            color=color)
+
+    def sweep(self, c_min, c_max, count, thumb_size):
+        """Render count x count julia thumbnails of the current view in one
+        launch, for the c of a grid from c_min to c_max.
+
+        Returns the (count * width, count * height) pixels of the mosaic,
+        the thumbnail (i, j) being the one of c_min + (i, j) * step.
+        """
+        if self.numpy_backend():
+            raise RuntimeError("The sweep is not supported by the numpy "
+                               "backend")
+        width, height = thumb_size
+        radius = self.params["radius"]
+        self.set_view(float(self.params["center_real"]),
+                      float(self.params["center_imag"]), radius)
+        (min_x, min_y), (max_x, max_y) = self.plane_min, self.plane_max
+        steps = [(high - low) / max(count - 1, 1)
+                 for low, high in zip((c_min.real, c_min.imag),
+                                      (c_max.real, c_max.imag))]
+        step_x = (max_x - min_x) / (width - 1)
+        step_y = (max_y - min_y) / (height - 1)
+        view = (
+            np.double(round(min_x / step_x)), np.double(round(min_y / step_y)),
+            np.double(step_x), np.double(step_y),
+            np.uint32(count * height), np.uint32(width), np.uint32(height),
+            np.double(c_min.real), np.double(c_min.imag),
+            np.double(steps[0]), np.double(steps[1]),
+        )
+        render_args = self.gradient_args() + [
+            np.byte(True),
             np.uint32(self.params["max_iter"]),
             np.uint32(self.params.get("pre_iter", 0)),
             np.double(self.params["grad_freq"]),
             np.double(self.params["c_real"]),
             np.double(self.params["c_imag"]),
-        ]
-        for kernel_param in self.params["kernel_params_mod"]:
-            render_args.append(np.double(self.params[kernel_param]))
-        nparray = self.gpu.render(*render_args)
-        if super_sampling > 1:
-            import scipy.ndimage
-            import scipy.misc
-            s = (self.window_size[0], self.window_size[1])
-            nparray = scipy.misc.imresize(
-                nparray.view(np.uint8).reshape(s[0]*super_sampling,
-                                               s[1]*super_sampling, 4),
-                s,
-                interp='cubic',
-                mode='RGBA')
-        self.blit(nparray.view(np.uint32))
-        self.draw = False
+        ] + [np.double(self.params[kernel_param])
+             for kernel_param in self.params["kernel_params_mod"]]
+        pixels = self.gpu.wait(self.gpu.submit(
+            (count * count * width * height,), view, render_args,
+            program=self.program("sweep")))
+        # The output buffers are re-used by the next frames
+        return pixels.reshape(count * width, count * height).copy()
+
+    def map_tiles(self):
+        """Compose the map view with the cached tiles"""
+        radius = self.params["map_radius"]
+        self.set_view(float(self.params["map_center_real"]),
+                      float(self.params["map_center_imag"]), radius)
+        digest = self.tiles_source.copy()
+        digest.update(repr(sorted(
+            (key, value) for key, value in self.params.items()
+            if key not in MAP_VIEW_PARAMS)).encode("utf-8"))
+        render_args = self.gradient_args() + [
+            np.byte(False),
+            np.uint32(self.params["max_iter"]),
+            np.uint32(self.params.get("pre_iter", 0)),
+            np.double(self.params["grad_freq"]),
+            np.double(self.params["c_real"]),
+            np.double(self.params["c_imag"]),
+        ] + [np.double(self.params[kernel_param])
+             for kernel_param in self.params["kernel_params_mod"]]
+
+        def render(rects):
+            # The output buffers are re-used by the next tiles
+            return [self.gpu.wait(self.gpu.submit(
+                (tiles.TILE * tiles.TILE,),
+                (np.double(x / step + 0.5), np.double(y / step + 0.5),
+                 np.double(step), np.double(step), np.uint32(tiles.TILE)),
+                render_args, program=self.tile_program)).copy()
+                for x, y, step in rects]
+
+        pixels = self.tiles.compose(
+            digest.hexdigest(), self.plane_min,
+            [2 * radius / (size - 1) for size in self.window_size],
+            self.window_size, render)
+        return self.gpu.submit_host((self.length,), pixels.ravel())
+
+    def host_plane(self, extent, super_sampling, tier=precision.DOUBLE):
+        """Return the coordinates of the host plane mode"""
+        width = self.window_size[0] * super_sampling
+        height = self.window_size[1] * super_sampling
+        x = np.linspace(extent[0][0], extent[1][0], width)
+        y = np.linspace(extent[0][1], extent[1][1], height) * 1j
+        plane = np.ravel(y+x[:, np.newaxis]).astype(np.complex128)
+        if tier == precision.FLOAT:
+            plane = plane.astype(np.complex64)
+        return plane
+
+    def view(self, extent, super_sampling, x=0, y=0, rect_height=None):
+        """Return the device plane mode arguments, of the rect starting at
+        the (x, y) pixel when set. The first pixel is the step grid point
+        nearest to the extent origin"""
+        width = self.window_size[0] * super_sampling
+        height = self.window_size[1] * super_sampling
+        step_x = (extent[1][0] - extent[0][0]) / (width - 1)
+        step_y = (extent[1][1] - extent[0][1]) / (height - 1)
+        if rect_height is not None:
+            height = rect_height * super_sampling
+        return (
+            np.double(round(extent[0][0] / step_x) + x * super_sampling),
+            np.double(round(extent[0][1] / step_y) + y * super_sampling),
+            np.double(step_x),
+            np.double(step_y),
+            np.uint32(height),
+        )
+
+    def samples_view(self, extent, super_sampling):
+        """Return the samples plane mode arguments, the samples being on
+        the super-sampled grid of the device mode"""
+        return self.view(extent, super_sampling)[:-1] + (
+            np.uint32(self.window_size[1]),)
+
+    def pixel_size(self):
+        """Return the plane distance between two pixels"""
+        radius = self.params["map_radius" if self.mapmode else "radius"]
+        super_sampling = self.params["super_sampling"]
+        return tuple(2 * radius * super_sampling / (size * super_sampling - 1)
+                     for size in self.window_size)
+
+    def pan_shift(self, view, tier):
+        """Return the (dx, dy) pixels translation of the view since the
+        previous frame, or None when the frame needs to be computed"""
+        params = repr(sorted(
+            (key, value) for key, value in self.params.items()
+            if key not in ("center_real", "center_imag")))
+        previous = self.previous_view
+        self.previous_view = (
+            self.gpu.frames + 1, self.window_size, tier, params,
+            int(view[0]), int(view[1]))
+        if previous is None or self.mapmode or self.deep_zoom() or \
+                self.series_approximation() or self.value_buffer() or \
+                self.params["plane_mode"] == "host" or \
+                previous[0] != self.gpu.frames or \
+                previous[1:4] != self.previous_view[1:4]:
+            return None
+        shift = []
+        super_sampling = self.params["super_sampling"]
+        for axis, size in enumerate(self.window_size):
+            # The grid index of the first pixel moved by whole pixels
+            offset, remainder = divmod(
+                self.previous_view[4 + axis] - previous[4 + axis],
+                super_sampling)
+            if remainder or abs(offset) >= size:
+                return None
+            shift.append(offset)
+        return shift
+
+    def exposed(self, shift):
+        """Return the (x, y, width, height) rects exposed by a shift"""
+        width, height = self.window_size
+        dx, dy = shift
+        rects = []
+        if dx:
+            # The columns, full height
+            x = width - dx if dx > 0 else 0
+            rects.append((x, 0, abs(dx), height))
+        if dy:
+            # The rows, without the columns
+            x = 0 if dx > 0 else -dx
+            y = height - dy if dy > 0 else 0
+            rects.append((x, y, width - abs(dx), abs(dy)))
+        return rects
+
+    def progressive(self):
+        return self.params["progressive"] and \
+            self.params["plane_mode"] == "device" and not self.pipeline and \
+            not self.adaptive_sampling() and not self.value_buffer() and \
+            not self.mapmode
+
+    def progressive_pixels(self):
+        """Return the (pixels_list, count) of each progressive level,
+        without the pixels of the previous levels"""
+        if self.window_size not in self.progressive_levels:
+            width, height = self.window_size
+            x = np.arange(width)[:, np.newaxis]
+            y = np.arange(height)[np.newaxis, :]
+            gid = (x * height + y).astype(np.uint32)
+            computed = np.zeros((width, height), dtype=bool)
+            levels = []
+            for level in PROGRESSIVE_LEVELS:
+                mask = (x % level == 0) & (y % level == 0)
+                pixels = gid[mask & ~computed]
+                computed = mask
+                # Keep the array until the non-blocking upload is done
+                levels.append((self.gpu.upload(
+                    "level%d" % level, pixels), len(pixels), pixels))
+            self.progressive_levels[self.window_size] = levels
+        return self.progressive_levels[self.window_size]
+
+    def refine(self, first=False):
+        """Compute the progressive frame until the frame_budget is spent.
+
+        Returns the handle of the frame when a level is complete, or None.
+        The first level is always completed when first is set.
+        """
+        program, view, args, level, offset = self.progress
+        levels = self.progressive_pixels()
+        deadline = time.monotonic() + self.params["frame_budget"] / 1000.
+        while True:
+            pixels_list, count, _ = levels[level]
+            size = count - offset
+            if not first:
+                # Multiple of 64 pixels, for the work group sizes
+                size = min(size, 64 * max(1, int(
+                    self.refine_rate * (deadline - time.monotonic()) / 64)))
+            start = time.monotonic()
+            self.gpu.refine(
+                (self.length,), pixels_list, offset, size, view, args,
+                self.params["super_sampling"], program).wait()
+            elapsed = time.monotonic() - start
+            if elapsed > 0:
+                self.refine_rate = size / elapsed
+            offset += size
+            if offset == count:
+                self.progress[3:] = [level + 1, 0]
+                if level + 1 == len(levels):
+                    self.progress = None
+                return self.gpu.fill_blocks(
+                    (self.length,), PROGRESSIVE_LEVELS[level],
+                    self.window_size[1])
+            if time.monotonic() >= deadline:
+                self.progress[3:] = [level, offset]
+                return None
+
+    def subdivision(self):
+        return self.params["subdivision"] and \
+            self.params["kernel"] == "escape-time-gradient" and \
+            self.params["plane_mode"] == "device" and not self.pipeline and \
+            not self.adaptive_sampling() and not self.value_buffer() and \
+            not self.progressive() and not self.mapmode
+
+    def value_buffer(self):
+        return self.params["value_buffer"] and \
+            self.params["kernel"] != "orbit-rgb" and \
+            not self.adaptive_sampling() and not self.mapmode and \
+            not self.numpy_backend()
+
+    def values_key(self):
+        """Return the parameters of the values"""
+        return (self.window_size, repr(sorted(
+            (key, value) for key, value in self.params.items()
+            if key not in COLOR_PARAMS)))
+
+    def color(self, tier):
+        """Return the color program, arguments and values dtype of the
+        values computed in a precision tier"""
+        if tier == precision.DOUBLE:
+            return self.gpu.build(COLOR_KERNEL.format(
+                extension="#pragma OPENCL EXTENSION cl_khr_fp64 : enable",
+                value_type="ulong", real="double")), \
+                self.gradient_args() + [
+                    np.double(self.params["grad_freq"])], np.uint64
+        return self.gpu.build(COLOR_KERNEL.format(
+            extension="", value_type="uint", real="float")), \
+            self.gradient_args() + [
+                np.float32(self.params["grad_freq"])], np.uint32
+
+    def gradient_args(self):
+        """Return the gradient lookup table arguments, uploaded once"""
+        key = (self.params["gradient"], self.params["gradient_length"])
+        if key not in self.gradients:
+            lut = gradient.generate_lut(*key)
+            # Keep the array until the non-blocking upload is done
+            self.gradients[key] = (
+                self.gpu.upload("gradient %s %d" % key, lut), lut)
+        return [self.gradients[key][0], np.uint32(key[1])]
+
+    def adaptive_sampling(self):
+        return self.params["plane_mode"] == "device" and \
+            self.params["adaptive_sampling"] and \
+            self.params["super_sampling"] > 1 and not self.mapmode
+
+    def precision_tier(self, center, radius):
+        """Return the precision needed by the view"""
+        tier = self.params["precision"]
+        if self.mapmode or self.deep_zoom():
+            # The map uses the main scene program, and the perturbation
+            # kernel is double only
+            return precision.DOUBLE
+        if tier == "auto":
+            tier = precision.select(
+                center, radius,
+                max(self.window_size) * self.params["super_sampling"],
+                self.params["double_single"])
+        if tier == precision.DOUBLE_SINGLE and (
+                self.params["kernel"] != "escape-time-gradient" or
+                not is_quadratic(self.cl_params["formula"]) or
+                self.params["kernel_params_mod"] or
+                self.params["plane_mode"] != "device" or
+                self.adaptive_sampling() or self.series_approximation() or
+                self.interior_checks() or self.iteration_count() or
+                self.progressive() or self.subdivision()):
+            # The emulation is only implemented for the z*z + c
+            # escape-time-gradient
+            tier = precision.DOUBLE
+        return tier
+
+    def deep_zoom(self):
+        return self.params["deep_zoom"] and not self.params["julia"] and \
+            not self.mapmode and not self.numpy_backend() and \
+            is_quadratic(self.cl_params["formula"])
+
+    def series_approximation(self):
+        return self.params["series_approximation"] and \
+            self.params["kernel"] == "escape-time-gradient" and \
+            not self.params["julia"] and not self.mapmode and \
+            is_quadratic(self.cl_params["formula"])
+
+    def cardioid_check(self):
+        return self.params["cardioid_check"] and \
+            self.params["kernel"] == "escape-time-gradient" and \
+            not self.params["julia"] and not self.mapmode and \
+            is_quadratic(self.cl_params["formula"])
+
+    def periodicity_check(self):
+        return self.params["periodicity_check"] and \
+            self.params["kernel"] in ("escape-time-gradient",
+                                      "mean-distance") and \
+            not self.mapmode
+
+    def interior_checks(self):
+        return not self.deep_zoom() and not self.numpy_backend() and (
+            self.cardioid_check() or self.periodicity_check())
+
+    def iteration_count(self):
+        return self.count_iterations and \
+            self.params["kernel"] in ("escape-time-gradient",
+                                      "mean-distance") and \
+            not self.mapmode and not self.deep_zoom() and \
+            not self.numpy_backend()
+
+    def interior_overrides(self):
+        """Return the template variables of the interior checks"""
+        overrides = {"interior_init": "", "interior_check": ""}
+        if self.cardioid_check():
+            overrides["interior_init"] += interior.CARDIOID_INIT
+        if self.periodicity_check():
+            overrides["interior_init"] += interior.PERIODICITY_INIT
+            if self.params["kernel"] == "mean-distance":
+                overrides["interior_check"] = interior.MEAN_PERIODICITY_CHECK
+            else:
+                overrides["interior_check"] = interior.PERIODICITY_CHECK
+        return overrides
+
+    def reference(self, center, radius):
+        """Return the reference orbit of the view center"""
+        if self.params["xyinverted"]:
+            center = (center[1], center[0])
+        max_iter = self.params["max_iter"]
+        digits = perturbation.precision(radius)
+        key = (center, max_iter, digits)
+        if self.reference_key != key:
+            self.orbit, self.orbit_length = perturbation.reference_orbit(
+                center, max_iter, self.params["escape_distance"], digits)
+            self.orbit_buffer = None
+            self.series_key = None
+            self.reference_key = key
+        return self.orbit, self.orbit_length
+
+    def series(self, center, radius):
+        """Return the series approximation of the view"""
+        orbit, length = self.reference(center, radius)
+        if self.series_key != radius:
+            if self.params["series_approximation"]:
+                self.series_coefficients = perturbation.series_approximation(
+                    orbit, length, radius, self.params["escape_distance"])
+            else:
+                self.series_coefficients = (0, (0j, 0j, 0j))
+            log.debug("Series approximation: skipping %d iterations",
+                      self.series_coefficients[0])
+            self.series_key = radius
+        return self.series_coefficients
+
+    def reference_args(self, center, radius):
+        """Return the perturbation kernel arguments"""
+        orbit, length = self.reference(center, radius)
+        if self.orbit_buffer is None:
+            self.orbit_buffer = self.gpu.upload("orbit", orbit)
+        skip, coefficients = self.series(center, radius)
+        return [
+            self.orbit_buffer,
+            np.uint32(length),
+            np.uint32(self.params["max_iter"]),
+            np.double(self.params["grad_freq"]),
+            np.uint32(skip),
+        ] + list(map(np.complex128, coefficients))
+
+    def series_args(self, center, radius):
+        """Return the escape-time-gradient series arguments"""
+        orbit, length = self.reference(center, radius)
+        skip, coefficients = self.series(center, radius)
+        if self.params["xyinverted"]:
+            center = (center[1], center[0])
+        return [
+            np.uint32(skip),
+            np.complex128(complex(float(center[0]), float(center[1]))),
+            np.complex128(orbit[skip]),
+        ] + list(map(np.complex128, coefficients))
+
+    def display(self, frame, handle, view=None):
+        pixels = self.gpu.wait(handle)
+        self.blit(pixels)
+        if self.zoom_preview() and view is not None:
+            # The pixels array is re-used by the next frames
+            self.preview_source = (view, pixels.copy())
+        if len(handle) > 2:
+            counters = {name: int(count[0]) + (int(count[1]) << 32)
+                        for name, count in handle[2].items()}
+            if "interior_saved" in counters:
+                self.iterations_saved = counters["interior_saved"]
+                log.debug("Interior checks: %d iterations saved",
+                          self.iterations_saved)
+            self.iterations = counters.get("iterations")
+        self.rendered_frame = frame
         if self.mapmode:
             self.draw_previous_c()
-        return True
 
     def create_map_scene(self, win_size, params):
         self.map_scene = Fractal(win_size, params, gpu=self.gpu)
@@ -391,7 +1300,7 @@ class Fractal(game.Window, game.ComplexPlane):
         if self.params["show_map"]:
             if self.params["xyinverted"]:
                 c = complex(c.imag, c.real)
-            if not len(self.previous_c) or self.previous_c[-1] != c:
+            if not len(self.previous_c) or self.previous_c.last() != c:
                 self.previous_c.append(c)
                 self.draw = True
                 if not self.included(c):
@@ -401,9 +1310,10 @@ class Fractal(game.Window, game.ComplexPlane):
                     self.draw = True
 
     def draw_previous_c(self):
-        length = len(self.previous_c)
-        pos = 0
-        for c in self.previous_c:
-            pos += 1
-            self.draw_complex(
-                c, color=[100 + int(100 * (pos / length))]*3, width=2)
+        trail = self.previous_c.array()
+        length = len(trail)
+        # The older values are darker
+        gray = 100 + (100 * (np.arange(1, length + 1) / length)).astype(
+            np.int64)
+        self.draw_complex_points(
+            trail, np.repeat(gray[:, np.newaxis], 3, axis=1), width=2)
@@ -10,9 +10,14 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import numpy as np
 import pygame
 
 
+# The pixel offsets of the circles, keyed by size
+CIRCLES = {}
+
+
 def clock():
     return pygame.time.Clock()
 
@@ -74,6 +79,34 @@ class Window:
         else:
             self.surface.set_at(coord, color)
 
+    def draw_points(self, coords, colors, width=1):
+        """Draw the points of the (2, n) coords array like draw_point, with
+        the (n, 3) colors array, the last points being on top"""
+        if width > 1:
+            if width not in CIRCLES:
+                # The pixels of a pygame circle, drawn once
+                stamp = pygame.Surface((2 * width + 1,) * 2)
+                pygame.draw.circle(stamp, [255] * 3, (width, width), width)
+                CIRCLES[width] = np.nonzero(
+                    pygame.surfarray.array2d(stamp))
+            offsets = [offset - width for offset in CIRCLES[width]]
+        else:
+            offsets = [np.zeros(1, dtype=np.int64)] * 2
+        x, y = [(coord[:, np.newaxis] + offset).ravel()
+                for coord, offset in zip(coords, offsets)]
+        index = np.repeat(np.arange(len(colors)), len(offsets[0]))
+        inside = (x >= 0) & (x < self.window_size[0]) & \
+            (y >= 0) & (y < self.window_size[1])
+        # The index of the last point drawn on each pixel
+        top = np.full(self.window_size, -1, dtype=np.int64)
+        np.maximum.at(top, (x[inside], y[inside]), index[inside])
+        drawn = top >= 0
+        pixels = pygame.surfarray.pixels2d(self.surface)
+        pixels[drawn] = pygame.surfarray.map_array(
+            self.surface, np.asarray(colors))[top[drawn]]
+        # Unlock the surface
+        del pixels
+
     def blit(self, nparray):
         pygame.surfarray.blit_array(
             self.surface, nparray.reshape(*self.window_size))
@@ -88,9 +121,11 @@ class ComplexPlane:
                           center_imag + radius)
         # Coordinate conversion vector
         self.offset = (self.plane_min[0], self.plane_min[1])
+        # Computed from the radius, which is still valid when the center
+        # is too precise for a float (see deep_zoom)
         self.scale = (
-            self.window_size[0] / float(self.plane_max[0] - self.plane_min[0]),
-            self.window_size[1] / float(self.plane_max[1] - self.plane_min[1])
+            self.window_size[0] / float(2 * radius),
+            self.window_size[1] / float(2 * radius)
         )
 
     def convert_to_plane(self, screen_coord):
@@ -116,6 +151,20 @@ class ComplexPlane:
             self.draw_point(
                 self.convert_to_screen(complex_coord), color, width)
 
+    def draw_complex_points(self, complex_coords, colors, width=1):
+        """Draw the points of a complex array like draw_complex"""
+        included = (complex_coords.real >= self.plane_min[0]) & \
+            (complex_coords.imag >= self.plane_min[1]) & \
+            (complex_coords.real < self.plane_max[0]) & \
+            (complex_coords.imag < self.plane_max[1])
+        complex_coords = complex_coords[included]
+        self.draw_points(
+            [((complex_coords.real - self.offset[0]) *
+              self.scale[0]).astype(np.int64),
+             ((complex_coords.imag - self.offset[1]) *
+              self.scale[1]).astype(np.int64)],
+            np.asarray(colors)[included], width)
+
     def draw_axis(self, axis_color=(28, 28, 28)):
         center_coord = self.convert_to_screen(0j)
         self.draw_line(
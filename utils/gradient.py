@@ -14,6 +14,8 @@ import colorsys
 import io
 import math
 
+import numpy as np
+
 
 class Gradient:
     multi_gradients = False
@@ -24,6 +26,10 @@ class Gradient:
             colors_array.append(str(self.color(idx / length)))
         return ",".join(colors_array)
 
+    def to_lut(self, length):
+        return np.array([self.color(idx / length) for idx in range(length)],
+                        dtype=np.uint32)
+
 
 class GimpGradient(Gradient):
     """ Read and interpret a Gimp .ggr gradient file.
@@ -194,6 +200,10 @@ def generate_array(name, length):
     return get(name).to_array(length)
 
 
+def generate_lut(name, length):
+    return get(name).to_lut(length)
+
+
 DEFAULT_GRADIENTS = {
     "purples": """GIMP Gradient
 Name: Purples
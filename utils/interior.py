@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Early-out of the pixels that never escape.
+
+For z*z + c, the points of the main cardioid and of the period-2 bulb
+are detected before iterating:
+
+    q = (x - 1/4)^2 + y^2,  q * (q + (x - 1/4)) <= y^2 / 4
+    (x + 1)^2 + y^2 <= 1/16
+
+For any formula, Brent's cycle detection compares z with a saved value,
+which is updated at power of two iterations. When z comes back to the
+saved value, the orbit is periodic and the pixel is interior.
+
+The kernels count the skipped iterations in a 64 bits interior_saved
+counter made of two uints.
+"""
+
+INTERIOR_PARAMS = """,
+    __global uint *interior_saved"""
+
+# Add the remaining iterations to the counter, with the carry of the low
+# part on overflow
+COUNT_SAVED = """
+            if (atomic_add(&interior_saved[0], max_iter - iter) >
+                    UINT_MAX - (max_iter - iter))
+                atomic_inc(&interior_saved[1]);"""
+
+CARDIOID_INIT = """
+    if (!julia) {{
+        double q = (c.real - 0.25) * (c.real - 0.25) + c.imag * c.imag;
+        if (q * (q + (c.real - 0.25)) <= 0.25 * c.imag * c.imag ||
+                (c.real + 1.0) * (c.real + 1.0) + c.imag * c.imag <=
+                0.0625) {{""" + COUNT_SAVED + """
+            iter = max_iter;
+        }}
+    }}"""
+
+PERIODICITY_INIT = """
+    cdouble_t check_z = z;
+    uint check_period = 1;
+    uint check_iter = 0;
+    double check_sum = 0.0;"""
+
+PERIODIC = """fabs(z.real - check_z.real) < {periodicity_tolerance} &&
+            fabs(z.imag - check_z.imag) < {periodicity_tolerance}"""
+
+NEXT_CHECK = """
+        if (++check_iter == check_period) {{
+            check_z = z;
+            check_period *= 2;
+            check_iter = 0;
+            check_sum = 0.0;
+        }}"""
+
+# The escape-time interior pixels are black
+PERIODICITY_CHECK = """
+        if (""" + PERIODIC + """) {{
+            iter++;""" + COUNT_SAVED + """
+            break;
+        }}""" + NEXT_CHECK
+
+# The mean-distance of an interior pixel is extrapolated with the mean of
+# the last period
+MEAN_PERIODICITY_CHECK = """
+        if (iter > pre_iter) {{
+            check_sum += modulus;
+            if (""" + PERIODIC + """) {{
+                mean += check_sum / (check_iter + 1) * (max_iter - iter - 1);
+                iter++;""" + COUNT_SAVED + """
+                iter = max_iter;
+                break;
+            }}""" + NEXT_CHECK.replace("\n", "\n    ") + """
+        }}"""
@@ -10,30 +10,826 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+
 import numpy as np
 import pyopencl as cl
 
 
+log = logging.getLogger()
+
+# Image kernels, the pixels are stored column by column
+IMAGE_KERNELS = """
+uint4 channels(uint pixel) {
+    return (uint4)(pixel & 0xff, (pixel >> 8) & 0xff,
+                   (pixel >> 16) & 0xff, pixel >> 24);
+}
+
+uint average(uint4 sum, uint count) {
+    sum = (sum + count / 2) / count;
+    return sum.x | (sum.y << 8) | (sum.z << 16) | (sum.w << 24);
+}
+
+uint distance(uint a, uint b) {
+    uint4 d = abs_diff(channels(a), channels(b));
+    return max(max(d.x, d.y), d.z);
+}
+
+__kernel void detect_edges(
+    __global uint const *pixels,
+    __global uint *edges,
+    __global uint *edges_count,
+    uint const threshold,
+    uint const width,
+    uint const height
+) {
+    // List the pixels that differ from one of their neighbours
+    int gid = get_global_id(0);
+    uint x = gid / height;
+    uint y = gid % height;
+    uint pixel = pixels[gid];
+    uint diff = 0;
+    if (x > 0)
+        diff = max(diff, distance(pixel, pixels[gid - height]));
+    if (x + 1 < width)
+        diff = max(diff, distance(pixel, pixels[gid + height]));
+    if (y > 0)
+        diff = max(diff, distance(pixel, pixels[gid - 1]));
+    if (y + 1 < height)
+        diff = max(diff, distance(pixel, pixels[gid + 1]));
+    if (diff > threshold)
+        edges[atomic_inc(edges_count)] = gid;
+}
+
+__kernel void resolve_edges(
+    __global uint const *samples,
+    __global uint const *edges,
+    __global uint *pixels,
+    uint const count
+) {
+    // Average the count samples of each edge pixel
+    int gid = get_global_id(0);
+    uint4 sum = (uint4)(0);
+    for (uint i = 0; i < count; i++)
+        sum += channels(samples[gid * count + i]);
+    pixels[edges[gid]] = average(sum, count);
+}
+
+__kernel void downscale(
+    __global uint const *samples,
+    __global uint *pixels,
+    uint const factor,
+    uint const height
+) {
+    // Box filter of the factor x factor samples of each pixel
+    int gid = get_global_id(0);
+    uint x = gid / height;
+    uint y = gid % height;
+    uint samples_height = height * factor;
+    uint4 sum = (uint4)(0);
+    for (uint i = 0; i < factor; i++) {
+        __global uint const *column = samples +
+            (x * factor + i) * samples_height + y * factor;
+        for (uint j = 0; j < factor; j++)
+            sum += channels(column[j]);
+    }
+    pixels[gid] = average(sum, factor * factor);
+}
+
+__kernel void fill_blocks(
+    __global uint const *samples,
+    __global uint *pixels,
+    uint const level,
+    uint const height
+) {
+    // Fill each pixel with the sample of its level x level block
+    int gid = get_global_id(0);
+    uint x = gid / height;
+    uint y = gid % height;
+    pixels[gid] = samples[(x - x % level) * height + y - y % level];
+}
+
+__kernel void shift(
+    __global uint const *previous,
+    __global uint *pixels,
+    int const dx,
+    int const dy,
+    uint const height
+) {
+    // Copy the previous pixels translated by (dx, dy), the exposed ones
+    // are left as is
+    int gid = get_global_id(0);
+    int x = gid / height + dx;
+    int y = gid % height + dy;
+    if (x >= 0 && x < get_global_size(0) / height && y >= 0 && y < height)
+        pixels[gid] = previous[x * height + y];
+}
+
+__kernel void paste(
+    __global uint const *rect,
+    __global uint *pixels,
+    uint const x,
+    uint const y,
+    uint const rect_height,
+    uint const height
+) {
+    int gid = get_global_id(0);
+    pixels[(x + gid / rect_height) * height + y + gid % rect_height] =
+        rect[gid];
+}
+"""
+
+
+def available():
+    """Return True when an OpenCL platform is installed"""
+    try:
+        return bool(cl.get_platforms())
+    except cl.Error as e:
+        log.warning("OpenCL is not available (%s), rendering with numpy", e)
+        return False
+
+
+class KernelCache:
+    """Store compiled program binaries on disk.
+
+    Entries are keyed by a hash of the source, the devices, the driver and
+    the pyopencl versions, the least recently used ones are evicted past
+    max_entries.
+    The tuned work group size of an entry is stored along its binaries.
+    """
+    def __init__(self, path=None, max_entries=256):
+        if path is None:
+            path = os.path.join(
+                os.environ.get("XDG_CACHE_HOME",
+                               os.path.expanduser("~/.cache")),
+                "demo-code", "kernels")
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, devices, options=()):
+        digest = hashlib.sha256(source.encode("utf-8"))
+        # The sources include the pyopencl headers
+        digest.update(cl.VERSION_TEXT.encode("utf-8"))
+        for option in options:
+            digest.update(option.encode("utf-8"))
+        for device in devices:
+            for info in (device.platform.name, device.platform.version,
+                         device.name, device.version, device.driver_version):
+                digest.update(info.encode("utf-8"))
+        return digest.hexdigest()
+
+    def build(self, ctx, source, options=()):
+        devices = ctx.devices
+        fname = os.path.join(
+            self.path, self.key(source, devices, options) + ".bin")
+        binaries = self.load(fname, len(devices))
+        if binaries is not None:
+            try:
+                program = cl.Program(ctx, devices, binaries).build(
+                    options=list(options))
+                self.hits += 1
+                os.utime(fname)
+                log.info("Kernel cache hit %s (%d hits, %d misses)",
+                         fname, self.hits, self.misses)
+                return program
+            except (cl.Error, RuntimeError, ValueError):
+                log.warning("%s: invalid cached binaries", fname)
+        self.misses += 1
+        program = cl.Program(ctx, source).build(options=list(options))
+        log.info("Kernel cache miss %s (%d hits, %d misses)",
+                 fname, self.hits, self.misses)
+        try:
+            self.store(fname, program.get_info(cl.program_info.BINARIES))
+        except (OSError, cl.Error) as e:
+            log.warning("%s: couldn't store binaries: %s", fname, e)
+        return program
+
+    def load(self, fname, count):
+        try:
+            with open(fname, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        binaries = []
+        offset = 0
+        try:
+            for _ in range(count):
+                size, = struct.unpack_from("<Q", data, offset)
+                offset += 8
+                binaries.append(data[offset:offset + size])
+                offset += size
+        except struct.error:
+            return None
+        if offset != len(data) or not all(binaries):
+            return None
+        return binaries
+
+    def store(self, fname, binaries):
+        os.makedirs(self.path, exist_ok=True)
+        # Write to a temporary file so that concurrent readers never see
+        # a partial entry
+        tmp = "%s.%d.tmp" % (fname, os.getpid())
+        with open(tmp, "wb") as f:
+            for binary in binaries:
+                f.write(struct.pack("<Q", len(binary)))
+                f.write(binary)
+        os.replace(tmp, fname)
+        self.evict()
+
+    def load_tuning(self, key):
+        """Return the tuned configuration of an entry, or None"""
+        try:
+            with open(os.path.join(self.path, key + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store_tuning(self, key, config):
+        os.makedirs(self.path, exist_ok=True)
+        fname = os.path.join(self.path, key + ".json")
+        tmp = "%s.%d.tmp" % (fname, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(config, f)
+        os.replace(tmp, fname)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".bin"):
+                fname = os.path.join(self.path, name)
+                try:
+                    entries.append((os.stat(fname).st_mtime, fname))
+                except OSError:
+                    pass
+        entries.sort()
+        for _, fname in entries[:max(0, len(entries) - self.max_entries)]:
+            for name in (fname, fname[:-len(".bin")] + ".json"):
+                try:
+                    os.unlink(name)
+                except OSError:
+                    pass
+
+
 class OpenCLCompute:
     ctx = None
+    cache = KernelCache()
+    # The work group sizes tried by tune, None lets the runtime choose
+    LOCAL_SIZES = (None, 8, 16, 32, 64, 128, 256, 512)
+    # The shapes kept per buffer name: the scene, its map scene and the
+    # map tiles share the device
+    BUFFER_SHAPES = 3
 
-    def __init__(self, program):
+    def __init__(self, program, autotune=False):
         if self.ctx is None:
-            self.ctx = cl.create_some_context()
-            self.queue = cl.CommandQueue(self.ctx)
-        self.kernel = cl.Program(self.ctx, program).build()
+            # The context is shared by the instances
+            OpenCLCompute.ctx = cl.create_some_context()
+            OpenCLCompute.queue = cl.CommandQueue(self.ctx)
+        self.programs = {}
+        self.kernels = {}
+        # The kernel cache keys of the programs, and their local sizes
+        self.program_keys = {}
+        self.local_sizes = {}
+        self.autotune = autotune
+        self.kernel = self.build(program)
+        # Device buffers and pinned host arrays, keyed by (name, shape), the
+        # least recently used first
+        self.buffers = collections.OrderedDict()
+        # Last output buffer used per shape
+        self.slots = {}
+        # The counters of the frame, see counter
+        self.counters = {}
+        # Number of pixels refined by the last submit_adaptive
+        self.refined = 0
+        # Number of frames submitted
+        self.frames = 0
+
+    def build(self, program, options=()):
+        """Build a program, using the on-disk kernel cache"""
+        key = (program, tuple(options))
+        if key not in self.programs:
+            self.programs[key] = self.cache.build(self.ctx, program, options)
+            self.program_keys[self.programs[key]] = self.cache.key(
+                program, self.ctx.devices, options)
+        return self.programs[key]
+
+    def get_kernel(self, program, name="compute"):
+        """Return a kernel instance, retrieved once per program"""
+        key = (program, name)
+        if key not in self.kernels:
+            self.kernels[key] = cl.Kernel(program, name)
+        return self.kernels[key]
+
+    def local_size(self, program, size, run):
+        """Return the local size of the program for a global size.
+
+        The tuned size is loaded from the kernel cache. With autotune, a
+        program without one is tuned with run(local_size, global_size,
+        global_offset), which enqueues the kernel.
+        """
+        key = self.program_keys.get(program)
+        if key is None:
+            return None
+        if key not in self.local_sizes:
+            config = self.cache.load_tuning(key)
+            if config is None and self.autotune:
+                config = {"local_size": self.tune(program, size, run)}
+                self.cache.store_tuning(key, config)
+                # The tuning runs incremented the counters of the frame
+                for buf in self.counters.values():
+                    cl.enqueue_fill_buffer(
+                        self.queue, buf, np.uint32(0), 0, 8)
+            self.local_sizes[key] = (config or {}).get("local_size")
+        local_size = self.local_sizes[key]
+        # The global size must be a multiple of the local size
+        while local_size and size % local_size:
+            local_size //= 2
+        return (local_size,) if local_size else None
+
+    def tune(self, program, size, run):
+        """Return the fastest local size on a slice of the frame, 0 when
+        it is the runtime choice"""
+        # The slice is a multiple of all the local sizes
+        step = max(filter(None, self.LOCAL_SIZES))
+        count = min(size // step, 32) * step
+        if not count:
+            return 0
+        offset = (size - count) // 2
+        maximum = self.get_kernel(program).get_work_group_info(
+            cl.kernel_work_group_info.WORK_GROUP_SIZE, self.queue.device)
+        timings = {}
+        for local_size in self.LOCAL_SIZES:
+            if local_size and local_size > maximum:
+                continue
+            local_size = local_size and (local_size,)
+            # The first run includes the kernel setup
+            run(local_size, count, offset).wait()
+            start = time.monotonic()
+            run(local_size, count, offset).wait()
+            timings[local_size] = time.monotonic() - start
+        best = min(timings, key=timings.get)
+        log.info("Tuned local size: %s (%.1fms, %.1fms for the runtime "
+                 "choice)", best, timings[best] * 1e3, timings[None] * 1e3)
+        return best[0] if best else 0
+
+    def device_buffer(self, name, shape, dtype, flags):
+        """Return a device buffer, allocated once per shape"""
+        key = ("device", name, shape, np.dtype(dtype).str)
+        buf = self.pooled(key)
+        if buf is None:
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            buf = self.pool(key, cl.Buffer(self.ctx, flags, nbytes))
+        return buf
+
+    def host_array(self, name, shape, dtype):
+        """Return a host array backed by pinned memory, allocated once per
+        shape. The array is re-used by the next call, copy it to keep it"""
+        key = ("host", name, shape, np.dtype(dtype).str)
+        entry = self.pooled(key)
+        if entry is None:
+            mf = cl.mem_flags
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            pinned = cl.Buffer(
+                self.ctx, mf.READ_WRITE | mf.ALLOC_HOST_PTR, nbytes)
+            array, _ = cl.enqueue_map_buffer(
+                self.queue, pinned,
+                cl.map_flags.READ | cl.map_flags.WRITE,
+                0, shape, dtype, is_blocking=True)
+            entry = self.pool(key, (pinned, array))
+        return entry[1]
+
+    def pooled(self, key):
+        """Return a pooled buffer, or None"""
+        entry = self.buffers.get(key)
+        if entry is not None:
+            self.buffers.move_to_end(key)
+        return entry
+
+    def pool(self, key, entry):
+        """Add a buffer to the pool. The least recently used shapes of the
+        name are released past BUFFER_SHAPES, so that the buffers of the
+        previous window or super-sampling size don't stay allocated"""
+        self.buffers[key] = entry
+        shapes = [other for other in self.buffers if other[:2] == key[:2]]
+        for other in shapes[:max(0, len(shapes) - self.BUFFER_SHAPES)]:
+            # The pending commands keep the buffer until they complete
+            del self.buffers[other]
+        return entry
+
+    def upload(self, name, array):
+        """Enqueue the upload of an array without waiting"""
+        buf = self.device_buffer(
+            name, array.shape, array.dtype, cl.mem_flags.READ_ONLY)
+        cl.enqueue_copy(self.queue, buf, array, is_blocking=False)
+        return buf
+
+    def upload_plane(self, plane):
+        # Plane is the input array of complex coordinate
+        return self.upload("plane", plane)
 
     def render(self, plane, *args):
+        return self.wait(self.submit(
+            plane.shape, (self.upload_plane(plane),), args))
+
+    def render_view(self, shape, view, *args):
+        """Render without a plane array, the kernel computes the coordinates
+        from the view (plane_x, plane_y, step_x, step_y, plane_height), see
+        the device plane mode"""
+        return self.wait(self.submit(shape, view, args))
+
+    def submit(self, shape, plane_args, args, super_sampling=1, height=0,
+               program=None, color=None):
+        """Enqueue the kernel and the pixels read back without waiting.
+
+        Two output buffers are used in turn for each shape, so that the
+        next frame can be computed while the previous one is displayed.
+        When super_sampling is set, the kernel computes shape times
+        super_sampling squared samples, and they are reduced on the device
+        to the output of the given height.
+        When color is set, the kernel computes values of the color dtype
+        that are kept on the device, and they are colored with
+        recolor(shape, *color).
+        Returns a (event, pixels) handle to be passed to wait().
+        """
         mf = cl.mem_flags
-        # Plane is the input array of complex coordinate
-        plane_opencl = cl.Buffer(
-            self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=plane)
+        if program is None:
+            program = self.kernel
+        if color is not None:
+            samples_shape = (shape[0] * super_sampling ** 2,)
+            values = self.device_buffer(
+                "values", samples_shape, color[2], mf.READ_WRITE)
+            self.enqueue_compute(
+                program, samples_shape[0], plane_args, values, args)
+            return self.recolor(shape, *color, super_sampling, height)
+        pixels, pixels_opencl = self.output_buffers(shape)
+        if super_sampling > 1:
+            samples_shape = (shape[0] * super_sampling ** 2,)
+            samples_opencl = self.device_buffer(
+                "samples", samples_shape, np.uint32, mf.READ_WRITE)
+            self.enqueue_compute(
+                program, samples_shape[0], plane_args, samples_opencl, args)
+            self.get_kernel(self.build(IMAGE_KERNELS), "downscale")(
+                self.queue, shape, None, samples_opencl, pixels_opencl,
+                np.uint32(super_sampling), np.uint32(height))
+        else:
+            # Call kernel
+            self.enqueue_compute(
+                program, shape[0], plane_args, pixels_opencl, args)
+        return self.read_back(pixels, pixels_opencl)
+
+    def enqueue_compute(self, program, size, plane_args, output, args):
+        """Enqueue the kernel on size work items, with the tuned local
+        size"""
+        def run(local_size, count, offset):
+            return self.get_kernel(program)(
+                self.queue, (count,), local_size, *plane_args, output, *args,
+                global_offset=(offset,))
+        return run(self.local_size(program, size, run), size, 0)
+
+    def recolor(self, shape, program, args, dtype, super_sampling=1,
+                height=0):
+        """Enqueue the coloring of the values computed by the last submit"""
+        mf = cl.mem_flags
+        pixels, pixels_opencl = self.output_buffers(shape)
+        samples_shape = (shape[0] * super_sampling ** 2,)
+        values = self.device_buffer(
+            "values", samples_shape, dtype, mf.READ_WRITE)
+        if super_sampling > 1:
+            samples = self.device_buffer(
+                "samples", samples_shape, np.uint32, mf.READ_WRITE)
+            self.get_kernel(program, "color")(
+                self.queue, samples_shape, None, values, samples, *args)
+            self.get_kernel(self.build(IMAGE_KERNELS), "downscale")(
+                self.queue, shape, None, samples, pixels_opencl,
+                np.uint32(super_sampling), np.uint32(height))
+        else:
+            self.get_kernel(program, "color")(
+                self.queue, shape, None, values, pixels_opencl, *args)
+        return self.read_back(pixels, pixels_opencl)
+
+    def submit_shifted(self, shape, height, shift, rects, args,
+                       super_sampling=1, program=None):
+        """Enqueue a frame made of the previous frame of the same shape.
+
+        The previous pixels are translated by shift (dx, dy), and the
+        kernel computes the (x, y, width, height, plane_args) rects that
+        are exposed.
+        """
+        mf = cl.mem_flags
+        if program is None:
+            program = self.kernel
+        image = self.build(IMAGE_KERNELS)
+        previous = self.device_buffer(
+            "pixels%d" % self.slots[shape], shape, np.uint32, mf.READ_WRITE)
+        pixels, pixels_opencl = self.output_buffers(shape)
+        self.get_kernel(image, "shift")(
+            self.queue, shape, None, previous, pixels_opencl,
+            np.int32(shift[0]), np.int32(shift[1]), np.uint32(height))
+        # The rects are at most the size of the frame
+        rect_pixels = self.device_buffer(
+            "rect", shape, np.uint32, mf.READ_WRITE)
+        samples_shape = (shape[0] * super_sampling ** 2,)
+        samples = self.device_buffer(
+            "samples", samples_shape, np.uint32, mf.READ_WRITE)
+        for x, y, width, rect_height, plane_args in rects:
+            rect_shape = (width * rect_height,)
+            if super_sampling > 1:
+                self.enqueue_compute(
+                    program, rect_shape[0] * super_sampling ** 2,
+                    plane_args, samples, args)
+                self.get_kernel(image, "downscale")(
+                    self.queue, rect_shape, None, samples, rect_pixels,
+                    np.uint32(super_sampling), np.uint32(rect_height))
+            else:
+                self.enqueue_compute(
+                    program, rect_shape[0], plane_args, rect_pixels, args)
+            self.get_kernel(image, "paste")(
+                self.queue, rect_shape, None, rect_pixels, pixels_opencl,
+                np.uint32(x), np.uint32(y), np.uint32(rect_height),
+                np.uint32(height))
+        return self.read_back(pixels, pixels_opencl)
+
+    def refine(self, shape, pixels_list, offset, count, view, args,
+               super_sampling, program):
+        """Enqueue the computation of count pixels of the pixels_list,
+        starting at offset, with the samples_program (the "samples" plane
+        mode). The pixels are stored in the progressive buffer of shape,
+        see fill_blocks. Returns the event of the last kernel."""
+        mf = cl.mem_flags
+        samples_count = super_sampling ** 2
+        samples = self.device_buffer(
+            "samples", (shape[0] * samples_count,), np.uint32, mf.READ_WRITE)
+        progressive = self.device_buffer(
+            "progressive", shape, np.uint32, mf.READ_WRITE)
+        self.get_kernel(program)(
+            self.queue, (count * samples_count,), None,
+            pixels_list, np.uint32(super_sampling), *view, samples, *args,
+            global_offset=(offset * samples_count,))
+        return self.get_kernel(self.build(IMAGE_KERNELS), "resolve_edges")(
+            self.queue, (count,), None, samples, pixels_list, progressive,
+            np.uint32(samples_count), global_offset=(offset,))
+
+    def fill_blocks(self, shape, level, height):
+        """Enqueue the read back of the progressive buffer, where only one
+        pixel per level x level block is computed"""
+        pixels, pixels_opencl = self.output_buffers(shape)
+        progressive = self.device_buffer(
+            "progressive", shape, np.uint32, cl.mem_flags.READ_WRITE)
+        self.get_kernel(self.build(IMAGE_KERNELS), "fill_blocks")(
+            self.queue, shape, None, progressive, pixels_opencl,
+            np.uint32(level), np.uint32(height))
+        return self.read_back(pixels, pixels_opencl)
+
+    def evaluate(self, shape, gids, view, args, super_sampling, program):
+        """Compute the pixels of the gids array with the samples_program,
+        and return their colors"""
+        count = len(gids)
+        # Pad the list with its last pixel to a multiple of 64 pixels, for
+        # the work group sizes
+        padded = min(-(-count // 64) * 64, shape[0])
+        if padded > count:
+            gids = np.concatenate(
+                (gids, np.full(padded - count, gids[-1], dtype=np.uint32)))
+        pixels_list = self.device_buffer(
+            "pixels_list", shape, np.uint32, cl.mem_flags.READ_ONLY)
+        cl.enqueue_copy(self.queue, pixels_list, gids, is_blocking=False)
+        self.refine(shape, pixels_list, 0, padded, view, args,
+                    super_sampling, program)
+        progressive = self.device_buffer(
+            "progressive", shape, np.uint32, cl.mem_flags.READ_WRITE)
+        pixels = self.host_array("progressive", shape, np.uint32)
+        cl.enqueue_copy(self.queue, pixels, progressive)
+        return pixels[gids[:count]]
+
+    def submit_host(self, shape, pixels):
+        """Enqueue the upload of a frame computed on the host, so that the
+        next frames may re-use it like a computed one"""
+        output, output_opencl = self.output_buffers(shape)
+        output[:] = pixels
+        event = cl.enqueue_copy(
+            self.queue, output_opencl, output, is_blocking=False)
+        self.queue.flush()
+        return event, output
+
+    def submit_adaptive(self, shape, view, samples_view, args,
+                        samples_program, super_sampling, threshold,
+                        program=None):
+        """Enqueue an adaptive super-sampled render.
+
+        The kernel first computes one sample per pixel of the view. The
+        pixels that differ from one of their neighbours by more than
+        threshold are then computed again with the samples_program (the
+        "samples" plane mode) and the samples_view, using super_sampling
+        squared samples.
+        """
+        mf = cl.mem_flags
+        if program is None:
+            program = self.kernel
+        pixels, pixels_opencl = self.output_buffers(shape)
+        self.get_kernel(program)(
+            self.queue, shape, None, *view, pixels_opencl, *args)
+        image = self.build(IMAGE_KERNELS)
+        edges = self.device_buffer("edges", shape, np.uint32, mf.READ_WRITE)
+        edges_count = self.device_buffer(
+            "edges_count", (1,), np.uint32, mf.READ_WRITE)
+        count = self.host_array("edges_count", (1,), np.uint32)
+        count[0] = 0
+        cl.enqueue_copy(self.queue, edges_count, count, is_blocking=False)
+        self.get_kernel(image, "detect_edges")(
+            self.queue, shape, None, pixels_opencl, edges, edges_count,
+            np.uint32(threshold), np.uint32(shape[0] // view[-1]), view[-1])
+        cl.enqueue_copy(self.queue, count, edges_count).wait()
+        self.refined = int(count[0])
+        if self.refined:
+            samples_count = super_sampling ** 2
+            samples = self.device_buffer(
+                "samples", (shape[0] * samples_count,), np.uint32,
+                mf.READ_WRITE)
+            self.get_kernel(samples_program)(
+                self.queue, (self.refined * samples_count,), None,
+                edges, np.uint32(super_sampling), *samples_view, samples,
+                *args)
+            self.get_kernel(image, "resolve_edges")(
+                self.queue, (self.refined,), None, samples, edges,
+                pixels_opencl, np.uint32(samples_count))
+        return self.read_back(pixels, pixels_opencl)
+
+    def counter(self, name):
+        """Return a 64 bits device counter, as two uints, reset to zero"""
+        buf = self.device_buffer(
+            name, (2,), np.uint32, cl.mem_flags.READ_WRITE)
+        cl.enqueue_fill_buffer(self.queue, buf, np.uint32(0), 0, 8)
+        self.counters[name] = buf
+        return buf
+
+    def read_counter(self, name, buf, shape):
+        """Enqueue the read back of a counter after the last submit of shape.
+        Returns the event and the host counter, one per output slot"""
+        count = self.host_array(
+            "%s%d" % (name, self.slots[shape]), (2,), np.uint32)
+        event = cl.enqueue_copy(self.queue, count, buf, is_blocking=False)
+        self.queue.flush()
+        return event, count
+
+    def output_buffers(self, shape):
+        """Return the next pair of host and device output buffers"""
+        slot = self.slots[shape] = (self.slots.get(shape, -1) + 1) % 2
+        self.frames += 1
         # Pixels is the output array
-        pixels = np.empty(plane.shape, dtype=np.uint32)
-        pixels_opencl = cl.Buffer(self.ctx, mf.WRITE_ONLY, pixels.nbytes)
-        # Call kernel
-        self.kernel.compute(
-            self.queue, pixels.shape, None, plane_opencl, pixels_opencl, *args)
+        pixels = self.host_array("pixels%d" % slot, shape, np.uint32)
+        pixels_opencl = self.device_buffer(
+            "pixels%d" % slot, shape, np.uint32, cl.mem_flags.READ_WRITE)
+        return pixels, pixels_opencl
+
+    def read_back(self, pixels, pixels_opencl):
         # Read pixel buffer
-        cl.enqueue_copy(self.queue, pixels, pixels_opencl).wait()
+        event = cl.enqueue_copy(
+            self.queue, pixels, pixels_opencl, is_blocking=False)
+        self.queue.flush()
+        return event, pixels
+
+    def ready(self, handle):
+        """Return True when the frame of the handle is computed"""
+        return handle[0].command_execution_status == \
+            cl.command_execution_status.COMPLETE
+
+    def wait(self, handle):
+        # The handle may carry other host arrays after the pixels
+        event, pixels = handle[:2]
+        event.wait()
         return pixels
+
+
+def pool_devices(count=None):
+    """Return the devices of the platform selected by PYOPENCL_CTX.
+
+    The CPU devices are partitioned in count sub-devices, or per NUMA node
+    when count is None.
+    """
+    platform = cl.get_platforms()[
+        int(os.environ.get("PYOPENCL_CTX", "0").split(":")[0] or 0)]
+    devices = []
+    for device in platform.get_devices():
+        if device.type & cl.device_type.CPU:
+            if count:
+                partition = [cl.device_partition_property.EQUALLY,
+                             max(1, device.max_compute_units // count)]
+            else:
+                partition = [cl.device_partition_property.BY_AFFINITY_DOMAIN,
+                             cl.device_affinity_domain.NUMA]
+            try:
+                devices.extend(device.create_sub_devices(partition))
+                continue
+            except cl.Error as e:
+                log.info("%s: couldn't partition the device: %s",
+                         device.name, e)
+        devices.append(device)
+    return devices
+
+
+class DevicePool(OpenCLCompute):
+    """Split the frames between several devices.
+
+    Each device computes a contiguous range of the pixel indices. As the
+    pixels are stored column by column, a range is a band of columns whose
+    first and last columns can be partial, and whole columns with
+    super-sampling. The range sizes follow the throughput of each device,
+    measured with the events of the previous frames. The other methods run
+    on the first device.
+    """
+    def __init__(self, program, devices, autotune=False):
+        self.ctx = cl.Context(devices)
+        self.queues = [
+            cl.CommandQueue(
+                self.ctx, device,
+                properties=cl.command_queue_properties.PROFILING_ENABLE)
+            for device in devices]
+        self.queue = self.queues[0]
+        # Pixels per second of each device
+        self.rates = [1.0] * len(devices)
+        # The (device index, pixels, kernel event) of the last frame
+        self.bands = []
+        super().__init__(program, autotune)
+        log.info("Rendering on %s", ", ".join(
+            device.name for device in devices))
+
+    def balance(self):
+        """Update the devices throughput with the last frame events"""
+        if not all(self.ready((event,)) for _, _, event in self.bands):
+            return
+        for idx, count, event in self.bands:
+            elapsed = (event.profile.end - event.profile.start) * 1e-9
+            if elapsed > 0:
+                self.rates[idx] = (self.rates[idx] + count / elapsed) / 2
+        self.bands = []
+
+    def split(self, length, unit):
+        """Return the (start, end) band of each device, in multiple of
+        unit pixels"""
+        total = sum(self.rates)
+        bounds = [0]
+        for idx in range(len(self.rates)):
+            bounds.append(int(round(
+                length // unit * sum(self.rates[:idx + 1]) / total)) * unit)
+        bounds[-1] = length
+        return zip(bounds[:-1], bounds[1:])
+
+    def submit(self, shape, plane_args, args, super_sampling=1, height=0,
+               program=None, color=None):
+        if color is not None:
+            return super().submit(
+                shape, plane_args, args, super_sampling, height, program,
+                color)
+        mf = cl.mem_flags
+        if program is None:
+            program = self.kernel
+        self.balance()
+        pixels, pixels_opencl = self.output_buffers(shape)
+        samples_count = super_sampling ** 2
+        # The other devices wait for the uploads of the first queue
+        uploaded = cl.enqueue_marker(self.queue)
+        self.queue.flush()
+        read_backs = []
+        bands = self.split(shape[0], height if super_sampling > 1 else 1)
+        for idx, (start, end) in enumerate(bands):
+            if start == end:
+                continue
+            queue = self.queues[idx]
+            output = self.device_buffer(
+                "band%d" % idx, shape, np.uint32, mf.READ_WRITE)
+            if super_sampling > 1:
+                samples = self.device_buffer(
+                    "band_samples%d" % idx, (shape[0] * samples_count,),
+                    np.uint32, mf.READ_WRITE)
+                event = self.get_kernel(program)(
+                    queue, ((end - start) * samples_count,), None,
+                    *plane_args, samples, *args,
+                    global_offset=(start * samples_count,),
+                    wait_for=[uploaded])
+                self.get_kernel(self.build(IMAGE_KERNELS), "downscale")(
+                    queue, (end - start,), None, samples, output,
+                    np.uint32(super_sampling), np.uint32(height),
+                    global_offset=(start,))
+            else:
+                event = self.get_kernel(program)(
+                    queue, (end - start,), None, *plane_args, output, *args,
+                    global_offset=(start,), wait_for=[uploaded])
+            read_backs.append(cl.enqueue_copy(
+                queue, pixels[start:end], output, src_offset=start * 4,
+                is_blocking=False))
+            queue.flush()
+            self.bands.append((idx, end - start, event))
+        # Gather the bands in the output buffer, for the next frames made
+        # of the previous one
+        event = cl.enqueue_copy(
+            self.queue, pixels_opencl, pixels, is_blocking=False,
+            wait_for=read_backs)
+        self.queue.flush()
+        return event, pixels
@@ -0,0 +1,212 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Perturbation rendering of deep Mandelbrot zooms.
+
+One reference orbit Z is computed at the view center with arbitrary
+precision, then each pixel only iterates its difference to the reference
+in double precision:
+
+    dz' = 2 * Z * dz + dz * dz + dc
+
+When the pixel orbit gets closer to zero than its difference (the
+reference is no longer a good approximation, which would result in
+glitches), or when the reference escapes, the difference is rebased on
+the start of the reference orbit.
+
+The first iterations can be skipped with a series approximation of the
+difference, which is valid for every pixel of the view:
+
+    dz = A * dc + B * dc^2 + C * dc^3
+
+The view center is kept as a decimal string in the params to preserve
+its precision.
+"""
+
+import decimal
+import math
+
+import numpy as np
+
+
+KERNEL = """
+{color_macros}
+#pragma OPENCL EXTENSION cl_khr_byte_addressable_store : enable
+#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+
+double2 cmul(double2 a, double2 b) {{
+    return (double2)(a.x * b.x - a.y * b.y, a.x * b.y + a.y * b.x);
+}}
+
+__kernel void compute(
+    {plane_args}
+    __global {pixel_type} *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
+    __global double2 const *orbit,
+    uint const orbit_length,
+    uint const max_iter,
+    double const gradient_frequency,
+    uint const series_skip,
+    double2 const series_a,
+    double2 const series_b,
+    double2 const series_c
+) {{
+    int gid = get_global_id(0);
+    // The plane coordinates are relative to the reference
+    double2 dc = (double2)({pos_x}, {pos_y});
+    double2 dz = (double2)(0.0, 0.0);
+    double2 z;
+    double escape = {escape_distance};
+    double modulus;
+    uint ref = 0;
+    int iter = 0;
+    if (series_skip > 0) {{
+        double2 dc2 = cmul(dc, dc);
+        dz = cmul(series_a, dc) + cmul(series_b, dc2) +
+             cmul(series_c, cmul(dc2, dc));
+        ref = iter = series_skip;
+    }}
+    pixels[gid] = INTERIOR;
+    for (; iter < max_iter; iter++) {{
+        double2 r = orbit[ref];
+        dz = (double2)(
+            2.0 * (r.x * dz.x - r.y * dz.y) + dz.x * dz.x - dz.y * dz.y,
+            2.0 * (r.x * dz.y + r.y * dz.x) + 2.0 * dz.x * dz.y) + dc;
+        ref++;
+        z = orbit[ref] + dz;
+        modulus = dot(z, z);
+        if (modulus > escape * escape) {{
+            modulus = iter - log(log(sqrt(modulus))) / log(2.0f) +
+                             log(log(escape)) / log(2.0f);
+            modulus = modulus / (double)max_iter;
+            pixels[gid] = COLOR(modulus);
+            break;
+        }}
+        if (modulus < dot(dz, dz) || ref == orbit_length - 1) {{
+            // Rebase on the reference start
+            dz = z;
+            ref = 0;
+        }}
+    }}
+}}
+"""
+
+# Series approximation of the escape-time-gradient kernel, the coefficients
+# are relative to the series_center, the point of the reference orbit
+SERIES_PARAMS = """,
+    uint const series_skip,
+    double2 const series_center,
+    double2 const series_z,
+    double2 const series_a,
+    double2 const series_b,
+    double2 const series_c"""
+
+SERIES_INIT = """
+    if (series_skip > 0 && !julia) {{
+        cdouble_t dc = cdouble_new(
+            {pos_x} - series_center.x, {pos_y} - series_center.y);
+        cdouble_t dc2 = cdouble_mul(dc, dc);
+        cdouble_t dz = cdouble_add(
+            cdouble_add(
+                cdouble_mul(cdouble_new(series_a.x, series_a.y), dc),
+                cdouble_mul(cdouble_new(series_b.x, series_b.y), dc2)),
+            cdouble_mul(cdouble_new(series_c.x, series_c.y),
+                        cdouble_mul(dc2, dc)));
+        z = cdouble_add(cdouble_new(series_z.x, series_z.y), dz);
+        iter = series_skip;
+    }}
+"""
+
+
+def precision(radius):
+    """Return the number of digits needed for a view radius"""
+    return max(20, int(-math.log10(radius)) + 20)
+
+
+def shift(value, delta, deep=False):
+    """Add delta to a view coordinate.
+
+    Decimal strings are kept as is, with enough precision for delta.
+    """
+    if not deep and not isinstance(value, str):
+        return value + delta
+    value = decimal.Decimal(value)
+    delta = decimal.Decimal(delta)
+    with decimal.localcontext() as ctx:
+        # Keep 20 digits past the delta magnitude
+        ctx.prec = max(28, 20 + max(value.adjusted(), 0) - delta.adjusted())
+        return str(value + delta)
+
+
+def difference(value, other):
+    """Return value - other as a float, keeping the decimal strings
+    precision"""
+    if isinstance(value, str) or isinstance(other, str):
+        return float(decimal.Decimal(value) - decimal.Decimal(other))
+    return value - other
+
+
+def reference_orbit(center, max_iter, escape, digits):
+    """Compute the orbit of center until it escapes.
+
+    Returns an array of max_iter + 1 points, starting with 0, and the
+    orbit length.
+    """
+    orbit = np.zeros(max_iter + 1, dtype=np.complex128)
+    with decimal.localcontext() as ctx:
+        ctx.prec = digits
+        c_real = decimal.Decimal(center[0])
+        c_imag = decimal.Decimal(center[1])
+        z_real = decimal.Decimal(0)
+        z_imag = decimal.Decimal(0)
+        escape = decimal.Decimal(escape) ** 2
+        length = 1
+        for idx in range(1, max_iter + 1):
+            z_real, z_imag = (z_real * z_real - z_imag * z_imag + c_real,
+                              2 * z_real * z_imag + c_imag)
+            orbit[idx] = complex(float(z_real), float(z_imag))
+            length += 1
+            if z_real * z_real + z_imag * z_imag > escape:
+                break
+    return orbit, length
+
+
+def series_approximation(orbit, length, radius, escape, tolerance=1e-12):
+    """Find how many iterations can be skipped for a view radius.
+
+    The series coefficients are computed along the reference orbit, and
+    probes at the view corners and edges are iterated with the exact
+    perturbation formula. The series is used until its relative error
+    on a probe reaches tolerance, a probe needs to be rebased or it
+    escapes.
+
+    Returns the number of iterations to skip and the A, B, C coefficients.
+    """
+    probes = np.array([complex(x, y) * radius
+                       for x in (-1, 0, 1) for y in (-1, 0, 1) if x or y])
+    probes2 = probes * probes
+    probes3 = probes2 * probes
+    dz = np.zeros_like(probes)
+    a = b = c = 0j
+    skip, coefficients = 0, (0j, 0j, 0j)
+    for idx in range(length - 1):
+        ref = orbit[idx]
+        dz = 2 * ref * dz + dz * dz + probes
+        a, b, c = 2 * ref * a + 1, 2 * ref * b + a * a, 2 * ref * c + 2 * a * b
+        approximation = a * probes + b * probes2 + c * probes3
+        z = np.abs(orbit[idx + 1] + dz)
+        if (np.abs(approximation - dz) > tolerance * np.abs(dz)).any() or \
+                (z < np.abs(dz)).any() or (z > escape).any():
+            break
+        skip, coefficients = idx + 1, (a, b, c)
+    return skip, coefficients
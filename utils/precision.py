@@ -0,0 +1,192 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Floating point precision of the kernels.
+
+The kernels are written in double precision. When a pixel covers enough
+float ulps of the view coordinates, a single precision variant is used
+instead, which is much faster on most GPUs and on the CPU runtimes that
+vectorize floats.
+
+Between the float and double ranges, the z*z + c formula can also use a
+double-single emulation, where each value is stored as the unevaluated
+sum of two floats, giving about 44 bits of mantissa.
+"""
+
+import re
+
+import numpy as np
+
+
+FLOAT = "float"
+DOUBLE_SINGLE = "double-single"
+DOUBLE = "double"
+
+# Mantissa bits of each tier
+MANTISSA_BITS = {
+    FLOAT: 24,
+    DOUBLE_SINGLE: 44,
+}
+
+# Minimum number of ulps per pixel for the rounding errors to stay
+# invisible after the iterations
+ULPS_PER_PIXEL = 2 ** 10
+
+# The orbits grow to the escape radius, whatever the view, so the
+# coordinates precision is relative to at least this magnitude
+ORBIT_MAGNITUDE = 2.0
+
+# Double literals are float in the single precision variants
+SINGLE_OPTIONS = ("-cl-single-precision-constant",)
+
+
+def select(center, radius, pixels, double_single=False):
+    """Return the precision tier for a view.
+
+    pixels is the number of samples along the view diameter.
+    """
+    pixel_size = 2 * radius / pixels
+    magnitude = max(ORBIT_MAGNITUDE, radius + max(
+        abs(float(center[0])), abs(float(center[1]))))
+    for tier in (FLOAT, DOUBLE_SINGLE):
+        if tier == DOUBLE_SINGLE and not double_single:
+            continue
+        if pixel_size >= \
+                magnitude * 2.0 ** -MANTISSA_BITS[tier] * ULPS_PER_PIXEL:
+            return tier
+    return DOUBLE
+
+
+def single_precision(source):
+    """Convert a double precision kernel source to single precision"""
+    source = source.replace("#define PYOPENCL_DEFINE_CDOUBLE 1\n", "")
+    source = source.replace(
+        "#pragma OPENCL EXTENSION cl_khr_fp64 : enable\n", "")
+    source = re.sub(r"\bcdouble_", "cfloat_", source)
+    return re.sub(r"\bdouble(\d*)\b", r"float\1", source)
+
+
+def single_args(args):
+    """Convert double kernel arguments to single precision"""
+    converted = []
+    for arg in args:
+        if isinstance(arg, np.float64):
+            arg = np.float32(arg)
+        elif isinstance(arg, np.complex128):
+            arg = np.complex64(arg)
+        converted.append(arg)
+    return converted
+
+
+def view_args(view, tier):
+    """Convert the device plane mode arguments to a precision tier"""
+    if tier == DOUBLE_SINGLE:
+        return tuple(map(split, view[:4])) + tuple(view[4:])
+    if tier == FLOAT:
+        return tuple(single_args(view))
+    return view
+
+
+def split(value):
+    """Return a value as a double-single (high, low) float2 argument"""
+    high = np.float32(value)
+    low = np.float32(float(value) - float(high))
+    return np.complex64(complex(high, low))
+
+
+# The double-single plane mode, computing the coordinates of each work
+# item like the "device" plane mode
+PLANE_MODE = {
+    "plane_args": """float2 const plane_x,
+    float2 const plane_y,
+    float2 const step_x,
+    float2 const step_y,
+    uint const plane_height,""",
+    "x": "x",
+    "y": "y",
+}
+
+
+# The escape-time-gradient kernel for z*z + c, in double-single. The
+# arithmetic follows Dekker and the DSFUN90 library, it relies on
+# each float operation being rounded, thus the contraction is disabled
+DOUBLE_SINGLE_KERNEL = """
+{color_macros}
+#pragma OPENCL EXTENSION cl_khr_byte_addressable_store : enable
+#pragma OPENCL FP_CONTRACT OFF
+
+float2 ds_quick_two_sum(float a, float b) {{
+    float s = a + b;
+    return (float2)(s, b - (s - a));
+}}
+
+float2 ds_add(float2 a, float2 b) {{
+    float s = a.x + b.x;
+    float v = s - a.x;
+    float e = (a.x - (s - v)) + (b.x - v);
+    return ds_quick_two_sum(s, e + a.y + b.y);
+}}
+
+float2 ds_mul(float2 a, float2 b) {{
+    float p = a.x * b.x;
+    float e = fma(a.x, b.x, -p);
+    return ds_quick_two_sum(p, e + a.x * b.y + a.y * b.x);
+}}
+
+__kernel void compute(
+    {plane_args}
+    __global {pixel_type} *pixels,
+    __global uint const *gradient,
+    uint const gradient_length,
+    char const julia,
+    uint const max_iter,
+    uint const pre_iter,
+    float const gradient_frequency,
+    float2 const c_real,
+    float2 const c_imag
+) {{
+    int gid = get_global_id(0);
+    float2 x = ds_mul(
+        step_x, ds_add(plane_x, (float2)(gid / plane_height, 0.0f)));
+    float2 y = ds_mul(
+        step_y, ds_add(plane_y, (float2)(gid % plane_height, 0.0f)));
+    float2 z_real, z_imag, c_r, c_i;
+    if (julia) {{
+        z_real = {pos_x};
+        z_imag = {pos_y};
+        c_r = c_real;
+        c_i = c_imag;
+    }} else {{
+        z_real = z_imag = (float2)(0.0f, 0.0f);
+        c_r = {pos_x};
+        c_i = {pos_y};
+    }}
+    float escape = {escape_distance};
+    float modulus;
+    pixels[gid] = INTERIOR;
+    for (int iter = 0; iter < max_iter; iter++) {{
+        float2 real2 = ds_mul(z_real, z_real);
+        float2 imag2 = ds_mul(z_imag, z_imag);
+        float2 cross = ds_mul(z_real, z_imag);
+        z_imag = ds_add(ds_add(cross, cross), c_i);
+        z_real = ds_add(ds_add(real2, -imag2), c_r);
+        modulus = sqrt(z_real.x * z_real.x + z_imag.x * z_imag.x);
+        if (modulus > escape) {{
+            modulus = iter - log(log(modulus)) / log(2.0f) +
+                             log(log(escape)) / log(2.0f);
+            modulus = modulus / (float)max_iter;
+            pixels[gid] = COLOR(modulus);
+            break;
+        }}
+    }}
+}}
+"""
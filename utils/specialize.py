@@ -0,0 +1,48 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Specialized variants of the kernels.
+
+The generic kernels branch on the julia argument, test the escape with
+cdouble_abs, which is an hypot, at every iteration. The variants have:
+
+- the julia branch resolved when building, the argument is kept so that
+  the variants are called like the generic kernel,
+- the escape tested on the squared modulus, the square root being only
+  computed for the escaped pixels.
+
+The formulas are not expanded to real arithmetic: the compiler contracts
+the expanded products to different fma, and the rounding differences grow
+into whole regions of the chaotic formulas.
+
+The kernel params stay arguments, as they are modulated every frame.
+"""
+
+import re
+
+
+ESCAPE_TEST = re.compile(
+    r"modulus = cdouble_abs\(z\);(\s*)if \(modulus > escape\) \{")
+
+ESCAPE = re.compile(r"(double escape = [^;]*;)")
+
+
+def kernel(source, julia):
+    """Return the kernel source specialized for the julia value"""
+    source = re.sub(r"\bif \(julia\)", "if (%d)" % bool(julia), source)
+    source, count = ESCAPE_TEST.subn(
+        r"modulus = z.real * z.real + z.imag * z.imag;"
+        r"\1if (modulus > escape2) {\1    modulus = sqrt(modulus);", source)
+    if count:
+        source = ESCAPE.sub(r"\1\n    double escape2 = escape * escape;",
+                            source, count=1)
+    return source
@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Mariani-Silver rectangle subdivision.
+
+The escape-time images have large connected regions of the same color.
+The frame is split in tiles, and only the borders of the tiles are
+computed. When the whole border of a tile has the same color, its inside
+is filled with that color, otherwise the tile is split in four and the
+borders of the sub-tiles are computed. The inside of the tiles smaller
+than min_size is computed pixel per pixel.
+
+The borders of every tile of a level are computed in one batch by an
+evaluate(gids) callback, which returns the color of each pixel of the
+gids array, the pixels being stored column by column.
+
+The fill is exact for the regions whose borders enclose them, such as
+the interior of the Mandelbrot set, but a detail that is entirely inside
+a uniform border, like a small minibrot, is lost.
+"""
+
+import numpy as np
+
+
+def borders(rects, shape):
+    """Return the mask of the border pixels of the (x0, y0, x1, y1) rects,
+    the coordinates being inclusive"""
+    mask = np.zeros(shape, dtype=bool)
+    for x0, y0, x1, y1 in rects:
+        mask[x0:x1 + 1, y0] = True
+        mask[x0:x1 + 1, y1] = True
+        mask[x0, y0:y1 + 1] = True
+        mask[x1, y0:y1 + 1] = True
+    return mask
+
+
+def render(width, height, evaluate, tile=64, min_size=4):
+    """Compute a frame by subdivision.
+
+    Returns the (width, height) pixels and the number of filled pixels.
+    """
+    shape = (width, height)
+    pixels = np.zeros(shape, dtype=np.uint32)
+    computed = np.zeros(shape, dtype=bool)
+    filled = 0
+    # The neighbour tiles share their borders
+    rects = [(x, y, min(x + tile, width - 1), min(y + tile, height - 1))
+             for x in range(0, max(width - 1, 1), tile)
+             for y in range(0, max(height - 1, 1), tile)]
+    while rects:
+        gids = np.flatnonzero(borders(rects, shape) & ~computed)
+        if len(gids):
+            pixels.flat[gids] = evaluate(gids.astype(np.uint32))
+            computed.flat[gids] = True
+        split = []
+        for x0, y0, x1, y1 in rects:
+            if x1 - x0 < 2 or y1 - y0 < 2:
+                # No inside
+                continue
+            color = pixels[x0, y0]
+            if (pixels[x0:x1 + 1, (y0, y1)] == color).all() and \
+                    (pixels[(x0, x1), y0:y1 + 1] == color).all():
+                pixels[x0 + 1:x1, y0 + 1:y1] = color
+                computed[x0 + 1:x1, y0 + 1:y1] = True
+                filled += (x1 - x0 - 1) * (y1 - y0 - 1)
+            elif x1 - x0 > min_size and y1 - y0 > min_size:
+                x, y = (x0 + x1) // 2, (y0 + y1) // 2
+                split.extend(((x0, y0, x, y), (x, y0, x1, y),
+                              (x0, y, x, y1), (x, y, x1, y1)))
+        rects = split
+    # The inside of the small tiles
+    gids = np.flatnonzero(~computed)
+    if len(gids):
+        pixels.flat[gids] = evaluate(gids.astype(np.uint32))
+    return pixels, filled
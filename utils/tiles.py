@@ -0,0 +1,164 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tile pyramid of the map scene.
+
+The plane is split in square tiles of TILE x TILE pixels, the tiles of the
+zoom level L being SPAN / 2 ** L wide. A view is composed with the tiles of
+the first level whose pixels are not larger than the view pixels, each view
+pixel taking the tile pixel it falls in. Only the missing tiles are
+rendered, the others come from a least recently used cache, and optionally
+from the disk, where the least recently used tiles are evicted past
+max_stored tiles.
+"""
+
+import collections
+import logging
+import math
+import os
+
+import numpy as np
+
+
+log = logging.getLogger()
+
+TILE = 64
+# Width of the level 0 tiles
+SPAN = 4.0
+
+
+class TileCache:
+    def __init__(self, path=None, max_tiles=1024, max_stored=16384):
+        self.path = path
+        self.max_tiles = max_tiles
+        # A tile is 16KiB on disk
+        self.max_stored = max_stored
+        # The tiles pixels, keyed by (params, level, x, y)
+        self.tiles = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def level(pixel_size):
+        return math.ceil(math.log2(SPAN / (TILE * pixel_size)))
+
+    def compose(self, params, origin, pixel_size, shape, render):
+        """Return the pixels of a view of shape (width, height), whose first
+        pixel is at origin.
+
+        The missing tiles are rendered by render(tiles), with the
+        (x, y, step) origin and pixel step of each tile, which returns
+        their TILE * TILE pixels stored column by column.
+        """
+        level = self.level(min(pixel_size))
+        span = SPAN / 2 ** level
+        # The level pixel of each view column and row
+        pixels = [np.floor(
+            (origin[axis] + np.arange(shape[axis]) * pixel_size[axis]) /
+            span * TILE).astype(np.int64) for axis in (0, 1)]
+        first = [int(pixels[axis][0]) // TILE for axis in (0, 1)]
+        count = [int(pixels[axis][-1]) // TILE - first[axis] + 1
+                 for axis in (0, 1)]
+        keys = [(params, level, first[0] + x, first[1] + y)
+                for x in range(count[0]) for y in range(count[1])]
+        tiles = {key: self.get(key) for key in keys}
+        missing = [key for key, tile in tiles.items() if tile is None]
+        if missing:
+            for key, tile in zip(missing, render([
+                    (x * span, y * span, span / TILE)
+                    for _, _, x, y in missing])):
+                tiles[key] = self.put(key, tile.reshape(TILE, TILE))
+            log.debug("Map tiles: %d/%d rendered (%d hits, %d misses)",
+                      len(missing), len(keys), self.hits, self.misses)
+            if self.path:
+                self.evict()
+        mosaic = np.empty((count[0] * TILE, count[1] * TILE), np.uint32)
+        for _, _, x, y in keys:
+            x0, y0 = (x - first[0]) * TILE, (y - first[1]) * TILE
+            mosaic[x0:x0 + TILE, y0:y0 + TILE] = \
+                tiles[(params, level, x, y)]
+        return mosaic[
+            (pixels[0] - first[0] * TILE)[:, np.newaxis],
+            (pixels[1] - first[1] * TILE)[np.newaxis, :]]
+
+    def get(self, key):
+        """Return the pixels of a tile, or None when it isn't cached"""
+        tile = self.tiles.get(key)
+        if tile is None and self.path:
+            tile = self.load(key)
+            if tile is not None:
+                self.put(key, tile, store=False)
+        if tile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile, store=True):
+        if self.path and store:
+            self.store(key, tile)
+        self.tiles[key] = tile
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def fname(self, key):
+        params, level, x, y = key
+        return os.path.join(
+            self.path, params, str(level), "%d_%d.npy" % (x, y))
+
+    def load(self, key):
+        try:
+            tile = np.load(self.fname(key))
+            # The mtime orders the stored tiles for evict
+            os.utime(self.fname(key))
+        except (OSError, ValueError):
+            return None
+        if tile.shape != (TILE, TILE) or tile.dtype != np.uint32:
+            log.warning("%s: invalid tile", self.fname(key))
+            return None
+        return tile
+
+    def store(self, key, tile):
+        fname = self.fname(key)
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            np.save(fname, tile)
+        except OSError as e:
+            log.warning("%s: couldn't store the tile: %s", fname, e)
+
+    def evict(self):
+        entries = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(".npy"):
+                    fname = os.path.join(root, name)
+                    try:
+                        entries.append((os.stat(fname).st_mtime, fname))
+                    except OSError:
+                        pass
+        entries.sort()
+        for _, fname in entries[:max(0, len(entries) - self.max_stored)]:
+            try:
+                os.unlink(fname)
+                # The level directory is removed with its last tile
+                os.rmdir(os.path.dirname(fname))
+            except OSError:
+                pass
+
+
+def cache_path():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "demo-code", "tiles")